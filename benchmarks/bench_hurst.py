@@ -0,0 +1,70 @@
+"""Compare the per-channel hurst loop with the batched hurst_batch
+
+Usage: python -m benchmarks.bench_hurst [--channels 129] [--duration 60]
+"""
+from scripts.preprocess import preprocess as pre
+
+import argparse
+import time
+
+import numpy as np
+
+
+def bench_hurst(n_channels, duration, sfreq, repeat):
+    """Time both Hurst implementations on random-walk data
+    Parameters
+    ----------
+    n_channels: int
+                number of channels of the synthetic recording
+    duration:   float
+                length of the synthetic recording in seconds
+    sfreq:  float
+            sampling rate in Hz
+    repeat: int
+            number of timed runs, the fastest of which is kept
+
+    Returns
+    ----------
+    results:    dict
+                best timing of each implementation, the speedup and the
+                largest absolute difference between their estimates
+    """
+    rng = np.random.RandomState(0)
+    n_times = int(duration * sfreq)
+    data = np.cumsum(rng.randn(n_channels, n_times), axis=1) * 1e-6
+
+    loop_times, batch_times = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        h_loop = np.array([pre.hurst(ch) for ch in data])
+        loop_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        h_batch = pre.hurst_batch(data)
+        batch_times.append(time.perf_counter() - start)
+
+    return {"channels": n_channels,
+            "samples": n_times,
+            "loop (s)": min(loop_times),
+            "batch (s)": min(batch_times),
+            "speedup": min(loop_times) / min(batch_times),
+            "max abs diff": float(np.nanmax(np.abs(h_loop - h_batch)))}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--channels", type=int, default=129)
+    parser.add_argument("--duration", type=float, default=60.0,
+                        help="recording length in seconds")
+    parser.add_argument("--sfreq", type=float, default=500.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    results = bench_hurst(args.channels, args.duration, args.sfreq,
+                          args.repeat)
+    for key, value in results.items():
+        print("{:<14}{}".format(key, value))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+"""Time every preprocessing step and the full run.py chain on synthetic data
+
+Usage: python -m benchmarks.bench_pipeline [--channels 64 129]
+       [--duration 60 600] [--sfreq 500] [--event-rate 0.5] [--no-artifacts]
+       [--skip ica_raw final_reject_epoch] [--precision-check]
+       [--output results.json] [--compare baseline.json]
+"""
+from benchmarks import synthetic
+from scripts.data import write
+from scripts.pipeline import metrics, runner
+from scripts.preprocess import preprocess
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import tempfile
+
+import mne
+import numpy as np
+
+
+def bench_params(skip=()):
+    """Template preprocess parameters adapted to the synthetic recordings"""
+    preprocess_params = write.write_template_params("")["preprocess"]
+    preprocess_params["ica_raw"]["montage"] = synthetic.MONTAGE
+    preprocess_params["segment_data"]["preload"] = True
+    return {func: params for func, params in preprocess_params.items()
+            if func not in skip}
+
+
+def _supported_steps(preprocess_params, n_channels):
+    """Leave out steps that cannot run on recordings of n_channels"""
+    # identify_badchans_raw takes channel 129 as reference (CMI layout)
+    if n_channels < 129:
+        return {func: params for func, params in preprocess_params.items()
+                if func != "identify_badchans_raw"}
+    return preprocess_params
+
+
+def bench_steps(raw, preprocess_params, repeat):
+    """Time each step of the chain on the output of the steps before it
+    Parameters
+    ----------
+    raw:    mne.io.Raw
+            synthetic recording, left unmodified
+    preprocess_params:  dict
+                        ordered pipeline steps and their parameters
+    repeat: int
+            number of runs of the chain, the fastest run of each step is kept
+
+    Returns
+    ----------
+    steps:  dict
+            wall time, CPU time and peak RSS of every step
+    """
+    best = {}
+    for _ in range(repeat):
+        step_metrics = {}
+        eeg_obj = raw.copy()
+        for func, params in preprocess_params.items():
+            with metrics.measure(step_metrics, func):
+                eeg_obj, _ = getattr(preprocess, func)(eeg_obj, **params)
+
+        for func, values in step_metrics.items():
+            if func not in best or \
+                    values["wall_time"] < best[func]["wall_time"]:
+                best[func] = values
+    return best
+
+
+def _run_chain(raw, preprocess_params, precision):
+    """Output of the chain with the data kept in precision between steps"""
+    eeg_obj = runner.set_precision(raw.copy(), precision)
+    for func, params in preprocess_params.items():
+        eeg_obj, _ = getattr(preprocess, func)(eeg_obj, **params)
+        runner.set_precision(eeg_obj, precision)
+    return eeg_obj
+
+
+# largest difference of the single-precision output allowed by
+# --precision-check, relative to the largest absolute value of the double one.
+# float32 carries about 7 significant digits, the chain loses some of them
+PRECISION_RTOL = 1e-5
+
+
+def check_precision(raw, preprocess_params):
+    """Compare the output of the chain in single and double precision
+    Parameters
+    ----------
+    raw:    mne.io.Raw
+            synthetic recording, left unmodified
+    preprocess_params:  dict
+                        ordered pipeline steps and their parameters
+
+    Returns
+    ----------
+    check:  dict
+            channels marked bad in only one of the runs, epochs kept by only
+            one of them (AutoReject thresholds are data-driven, an epoch
+            close to one may flip), and the largest difference of the
+            single-precision output on the epochs both kept, relative to the
+            largest absolute value of the double one, and whether it is
+            within PRECISION_RTOL
+    """
+    # the same ICA initialization and AutoReject folds in both runs
+    preprocess_params = {func: dict(params) for func, params
+                         in preprocess_params.items()}
+    for func in ("ica_raw", "final_reject_epoch"):
+        if func in preprocess_params:
+            preprocess_params[func]["random_state"] = 0
+
+    double = _run_chain(raw, preprocess_params, "double")
+    single = _run_chain(raw, preprocess_params, "single")
+
+    x, y = double.get_data(), single.get_data()
+    check = {"bads": sorted(set(double.info["bads"])
+                            ^ set(single.info["bads"])),
+             "epochs": 0}
+    if x.ndim == 3:
+        common = np.intersect1d(double.selection, single.selection)
+        check["epochs"] = len(double) + len(single) - 2 * len(common)
+        x = x[np.isin(double.selection, common)]
+        y = y[np.isin(single.selection, common)]
+    check["max_rel_diff"] = float(np.abs(x - y).max() / np.abs(x).max())
+    check["passed"] = check["max_rel_diff"] <= PRECISION_RTOL
+    return check
+
+
+def bench_chain(raw_params, preprocess_params, work_dir):
+    """Time the full chain of run.py, loading and writing included
+    Parameters
+    ----------
+    raw_params: dict
+                keyword arguments of synthetic.make_raw
+    preprocess_params:  dict
+                        ordered pipeline steps and their parameters
+    work_dir:   str
+                directory the BIDS dataset and the derivatives are written to
+
+    Returns
+    ----------
+    chain:  dict
+            elapsed time of the file and the metrics recorded by the runner
+    """
+    bids_root = os.path.join(work_dir, "rawdata")
+    files = synthetic.make_dataset(bids_root, **raw_params)
+
+    write_params = {"root": os.path.join(work_dir, "output"), "cache": None,
+                    "intermediates": ["*"], "write_queue": 0}
+    result, = runner.preprocess_files(files, preprocess_params, "eeg",
+                                      write_params)
+    if result["status"] != "success":
+        raise RuntimeError(result["error"])
+
+    return {"wall_time": result["elapsed"], "metrics": result["metrics"]}
+
+
+def run_benchmarks(sizes, preprocess_params, repeat=1, chain=True,
+                   precision_check=False):
+    """Benchmark every combination of recording parameters
+    Parameters
+    ----------
+    sizes:  list
+            one dict of synthetic.make_raw keyword arguments per dataset
+    preprocess_params:  dict
+                        ordered pipeline steps and their parameters
+    repeat: int
+            number of timed runs of every step
+    chain:  bool
+            also time the full run.py chain on a BIDS copy of each dataset
+    precision_check:    bool
+                        also compare the chain output in single and double
+                        precision (see check_precision)
+
+    Returns
+    ----------
+    results:    dict
+                environment, parameters and timings, ready to dump as JSON
+    """
+    results = []
+    for raw_params in sizes:
+        print("Benchmarking {}".format(raw_params))
+        params = _supported_steps(preprocess_params,
+                                  raw_params["n_channels"])
+        raw = synthetic.make_raw(**raw_params)
+        skipped = sorted(set(preprocess_params) - set(params))
+        entry = dict(raw_params, skipped=skipped,
+                     steps=bench_steps(raw, params, repeat))
+
+        if chain:
+            with tempfile.TemporaryDirectory() as work_dir:
+                entry["chain"] = bench_chain(raw_params, params, work_dir)
+        if precision_check:
+            entry["precision"] = check_precision(raw, params)
+        results.append(entry)
+
+    return {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "versions": {"python": platform.python_version(),
+                         "mne": mne.__version__,
+                         "numpy": np.__version__},
+            "preprocess": preprocess_params,
+            "results": results}
+
+
+def _size_key(entry):
+    return tuple(entry[key] for key in ("n_channels", "duration", "sfreq",
+                                        "event_rate", "artifacts"))
+
+
+def compare(results, baseline):
+    """Print the speedup of every step over a previous run
+    Parameters
+    ----------
+    results:    dict
+                output of run_benchmarks
+    baseline:   dict
+                output of an earlier run_benchmarks, e.g. loaded from JSON
+    """
+    old = {_size_key(entry): entry for entry in baseline["results"]}
+    for entry in results["results"]:
+        base = old.get(_size_key(entry))
+        if base is None:
+            continue
+
+        print("\n{} channels, {} s, {} Hz".format(
+            entry["n_channels"], entry["duration"], entry["sfreq"]))
+        print("{:<22}{:>12}{:>12}{:>9}".format("", "baseline", "current",
+                                               "speedup"))
+        rows = [(func, base["steps"][func]["wall_time"], values["wall_time"])
+                for func, values in entry["steps"].items()
+                if func in base["steps"]]
+        if "chain" in entry and "chain" in base:
+            rows.append(("full chain", base["chain"]["wall_time"],
+                         entry["chain"]["wall_time"]))
+        for name, before, after in rows:
+            print("{:<22}{:>10.3f} s{:>10.3f} s{:>8.2f}x".format(
+                name, before, after, before / after))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--channels", type=int, nargs="+", default=[64, 129])
+    parser.add_argument("--duration", type=float, nargs="+", default=[60.0],
+                        help="recording lengths in seconds")
+    parser.add_argument("--sfreq", type=float, nargs="+", default=[500.0])
+    parser.add_argument("--event-rate", type=float, nargs="+", default=[0.5],
+                        help="events per second")
+    parser.add_argument("--no-artifacts", action="store_true",
+                        help="do not inject blinks, noisy channels and "
+                             "muscle bursts")
+    parser.add_argument("--skip", nargs="*", default=[],
+                        help="pipeline steps to leave out")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--no-chain", action="store_true",
+                        help="only time the steps, not the full run.py chain")
+    parser.add_argument("--precision-check", action="store_true",
+                        help="check that the output in single precision "
+                             "matches the output in double precision within "
+                             "a relative difference of {:.0e}, exit with an "
+                             "error otherwise".format(PRECISION_RTOL))
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    args = parser.parse_args(argv)
+    mne.set_log_level("WARNING")
+
+    sizes = [{"n_channels": n_channels, "duration": duration, "sfreq": sfreq,
+              "event_rate": event_rate, "artifacts": not args.no_artifacts}
+             for n_channels, duration, sfreq, event_rate in itertools.product(
+                 args.channels, args.duration, args.sfreq, args.event_rate)]
+
+    results = run_benchmarks(sizes, bench_params(args.skip), args.repeat,
+                             chain=not args.no_chain,
+                             precision_check=args.precision_check)
+
+    for entry in results["results"]:
+        print("\n{} channels, {} s, {} Hz".format(
+            entry["n_channels"], entry["duration"], entry["sfreq"]))
+        for func, values in entry["steps"].items():
+            print("{:<22}{:>10.3f} s{:>10.1f} MB".format(
+                func, values["wall_time"], values["peak_rss"]))
+        if "chain" in entry:
+            print("{:<22}{:>10.3f} s".format("full chain",
+                                             entry["chain"]["wall_time"]))
+        if "precision" in entry:
+            print("single vs double precision: {:.1e} max relative "
+                  "difference, {} epochs and {} bad channels differ".format(
+                      entry["precision"]["max_rel_diff"],
+                      entry["precision"]["epochs"],
+                      len(entry["precision"]["bads"])))
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=4, default=write.json_default)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(results, json.load(fp))
+
+    failed = [entry for entry in results["results"]
+              if not entry.get("precision", {}).get("passed", True)]
+    if failed:
+        raise SystemExit("single precision output differs by more than {:.0e}"
+                         " for {} dataset(s)".format(PRECISION_RTOL,
+                                                     len(failed)))
+
+
+if __name__ == "__main__":
+    main()
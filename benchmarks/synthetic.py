@@ -0,0 +1,150 @@
+"""Generate synthetic EEG recordings and BIDS datasets for benchmarking"""
+import os
+import tempfile
+
+import mne
+import mne_bids
+import numpy as np
+
+# channels the pipeline steps refer to by name (ica_raw uses FC1 as EOG proxy)
+REQUIRED_CHANNELS = ["Fp1", "Fp2", "FC1"]
+
+# last channel, used as reference like Cz (E129) of the CMI recordings
+REFERENCE = "Cz"
+
+MONTAGE = "standard_1005"
+
+
+def _channel_names(n_channels):
+    """Pick n_channels names of the montage, spread over the whole head"""
+    names = mne.channels.make_standard_montage(MONTAGE).ch_names
+    fixed = REQUIRED_CHANNELS + [REFERENCE]
+    others = [name for name in names if name not in fixed]
+    n_others = n_channels - len(fixed)
+    if n_others < 0 or n_others > len(others):
+        raise ValueError("n_channels must be between {} and {}".format(
+            len(fixed), len(names)))
+
+    picks = np.linspace(0, len(others) - 1, n_others).round().astype(int)
+    return REQUIRED_CHANNELS + [others[i] for i in picks] + [REFERENCE]
+
+
+def make_raw(n_channels=64, duration=60.0, sfreq=500.0, event_rate=0.5,
+             artifacts=True, seed=0):
+    """Simulate a continuous EEG recording with events and artifacts
+    Parameters
+    ----------
+    n_channels: int
+                number of EEG channels, named after the standard_1005 montage,
+                with Cz last
+    duration:   float
+                length of the recording in seconds
+    sfreq:  float
+            sampling rate in Hz
+    event_rate: float
+                mean number of events per second, alternating between two
+                conditions
+    artifacts:  bool
+                inject eye blinks on frontal channels, two noisy channels and
+                bursts of muscle activity
+    seed:   int
+            seed of the random generator
+
+    Returns
+    ----------
+    raw:    mne.io.RawArray
+            recording with montage set and events stored as annotations
+    """
+    rng = np.random.RandomState(seed)
+    names = _channel_names(n_channels)
+    n_times = int(duration * sfreq)
+    times = np.arange(n_times) / sfreq
+
+    # background: slow drifts, white noise and a 10 Hz alpha rhythm (V)
+    data = np.cumsum(rng.randn(n_channels, n_times), axis=1) * 1e-7
+    data += rng.randn(n_channels, n_times) * 5e-6
+    alpha_phase = rng.uniform(0, 2 * np.pi, (n_channels, 1))
+    data += 5e-6 * np.sin(2 * np.pi * 10 * times + alpha_phase)
+
+    info = mne.create_info(names, sfreq, "eeg")
+    raw = mne.io.RawArray(data, info, verbose=False)
+    raw.set_montage(MONTAGE)
+
+    if artifacts:
+        _add_artifacts(raw, rng)
+
+    # events at jittered intervals
+    n_events = int(duration * event_rate)
+    onsets = np.sort(rng.uniform(1, max(duration - 1, 1), n_events))
+    raw.set_annotations(mne.Annotations(
+        onsets, 0, ["stim/{}".format(i % 2) for i in range(n_events)]))
+    return raw
+
+
+def _add_artifacts(raw, rng):
+    """Add blinks, noisy channels and muscle bursts to raw in place"""
+    data = raw._data
+    sfreq = raw.info["sfreq"]
+    n_channels, n_times = data.shape
+
+    # blinks every ~4 s, strongest on the most frontal channels
+    pos = np.array([ch["loc"][:3] for ch in raw.info["chs"]])
+    frontal = np.clip((pos[:, 1] - pos[:, 1].min()) / np.ptp(pos[:, 1]), 0, 1)
+    blink = np.hanning(int(0.3 * sfreq)) * 150e-6
+    for onset in np.arange(2, n_times / sfreq - 1, 4) + rng.uniform(0, 1):
+        start = int(onset * sfreq)
+        stop = min(start + blink.size, n_times)
+        data[:, start:stop] += np.outer(frontal ** 4, blink[:stop - start])
+
+    # two noisy channels for identify_badchans_raw
+    noisy = rng.choice(n_channels, 2, replace=False)
+    data[noisy] *= 20
+
+    # broadband muscle bursts of 0.5 s on a few channels
+    burst = int(0.5 * sfreq)
+    for start in rng.randint(0, max(n_times - burst, 1), n_times //
+                             int(10 * sfreq) + 1):
+        picks = rng.choice(n_channels, max(n_channels // 10, 1),
+                           replace=False)
+        data[picks, start:start + burst] += \
+            rng.randn(picks.size, burst) * 20e-6
+
+
+def make_dataset(root, n_subjects=1, tasks=("bench",), **raw_params):
+    """Write a BrainVision BIDS dataset of synthetic recordings
+    Parameters
+    ----------
+    root:   str
+            root of the BIDS dataset to create
+    n_subjects: int
+                number of subjects, each with one session and run per task
+    tasks:  tuple
+            names of the tasks
+    raw_params: dict
+                keyword arguments of make_raw
+
+    Returns
+    ----------
+    files:  list
+            BIDS paths of the written recordings
+    """
+    files = []
+    seed = raw_params.pop("seed", 0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for subj in range(n_subjects):
+            for task in tasks:
+                raw = make_raw(seed=seed + len(files), **raw_params)
+
+                # write_raw_bids converts recordings read from disk
+                fname = os.path.join(tmp_dir, "raw.fif")
+                raw.save(fname, overwrite=True, verbose=False)
+                raw = mne.io.read_raw_fif(fname, verbose=False)
+
+                bids_path = mne_bids.BIDSPath(subject="{:02d}".format(subj),
+                                              session="01", task=task,
+                                              run="01", datatype="eeg",
+                                              root=root)
+                mne_bids.write_raw_bids(raw, bids_path, overwrite=True,
+                                        verbose=False)
+                files.append(bids_path)
+    return files
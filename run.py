@@ -1,45 +1,154 @@
-from scripts.data import load, write
-from scripts.preprocess import preprocess
+from scripts.data import load
+from scripts.pipeline import (manifest, metrics, planner, runner, scheduler,
+                              shard, workqueue)
 
-from collections import ChainMap
-
-import mne_bids
+import argparse
 import sys
 
-# load all parameters
-user_params = load.load_params("user_params.json")
 
-# get data and metadata parameters
-preprocess_params = user_params["preprocess"]
-data_params = user_params["load_data"]
-write_params = user_params["output_data"]
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the PEPPER pipeline")
+    parser.add_argument("subject", nargs="?", default=None,
+                        help="only process this subject")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="number of files processed in parallel")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue each file from the last intermediate "
+                             "whose upstream parameters are unchanged")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only process recordings that are new, changed "
+                             "or processed with other parameters since "
+                             "their last successful run")
+    parser.add_argument("--shard", type=_shard, default=None,
+                        metavar="i/N",
+                        help="only process shard i (0 to N - 1) of N groups "
+                             "of files balanced by size and channel count")
+    parser.add_argument("--queue", default=None, metavar="NAME",
+                        help="pull files from the work queue NAME shared "
+                             "by every task started with it, until all "
+                             "files are done")
+    parser.add_argument("--claim-ttl", type=float, default=600.,
+                        metavar="SECONDS",
+                        help="with --queue, seconds after which the files "
+                             "of a task that stopped responding are "
+                             "processed by another task")
+    parser.add_argument("--mem-budget", type=float, default=None,
+                        metavar="GB",
+                        help="only start a file while the estimated peak "
+                             "memory of all running files fits in GB")
+    parser.add_argument("--ica-copy", action="store_true",
+                        help="make the copy ica_raw trains on while "
+                             "filtering, holding a second copy of each "
+                             "recording in memory until ica_raw runs")
+    parser.add_argument("--plan", action="store_true",
+                        help="print the execution plan and its estimated "
+                             "savings without processing any file")
+    return parser.parse_args(argv)
+
+
+def _shard(value):
+    try:
+        return shard.parse_shard(value)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # load all parameters
+    user_params = load.load_params("user_params.json")
+
+    # get data and metadata parameters
+    preprocess_params = user_params["preprocess"]
+    data_params = user_params["load_data"]
+    write_params = user_params["output_data"]
+
+    # get channel type of data
+    ch_type = data_params["channel-type"]
+
+    # overwrite data_params using command line arguments
+    if args.subject is not None:
+        data_params["subjects"] = [args.subject]
+
+    # get set of subjects & tasks to run while omitting existing exceptions
+    data = load.load_files(data_params)
+
+    # keep this job's share of files when running as a job array
+    if args.shard is not None:
+        index, count = args.shard
+        data = shard.shard_files(data, index, count)
+        print("Shard {}/{}: {} files".format(index, count, len(data)))
+
+    # skip recordings already processed from the same input and parameters
+    manifest_file = manifest.manifest_path(write_params["root"])
+    manifest_entries = manifest.read_manifest(manifest_file)
+    digest = manifest.params_hash(preprocess_params, ch_type=ch_type,
+                                  precision=data_params.get("precision"))
+    if args.incremental:
+        data, reasons, touched = manifest.changed_files(
+            data, manifest_entries, digest)
+        # touched files are not hashed again by the next run
+        manifest.write_entries(manifest_file, touched)
+        print("Incremental run: {} new, {} changed, {} with new parameters, "
+              "{} unchanged".format(reasons["new"], reasons["changed"],
+                                    reasons["parameters"],
+                                    reasons["unchanged"]))
+
+    # remove redundant loads, copies and filter passes across steps
+    preload = data_params.get("preload")
+    plan = planner.make_plan(preprocess_params, write_params,
+                             lazy=preload is not None,
+                             ica_copy=args.ica_copy)
+    if args.plan:
+        # the bytes saved are estimated from the header of every file
+        planner.print_plan(plan, planner.estimate_savings(plan, data))
+        return
+    planner.print_plan(plan, planner.estimate_savings(plan), verbose=False)
 
-# get output root and channel type of data
-ch_type = data_params["channel-type"]
-output_path = write_params["root"]
+    # estimate the peak memory of every file from its header
+    model_file = scheduler.model_path(write_params["root"])
+    sizes, estimates, mem_budget = None, None, None
+    if args.mem_budget is not None:
+        model = scheduler.read_model(model_file)
+        sizes = scheduler.file_sizes(data)
+        steps = list(preprocess_params) + ["load", "write"]
+        estimates = [scheduler.estimate_mb(model, sizes[file.basename], steps)
+                     for file in data]
+        mem_budget = args.mem_budget * 1024
+    elif args.queue is not None:
+        # queued files are claimed largest first, by their size on disk
+        estimates = [manifest.input_state(file)["size"] for file in data]
 
-# overwrite data_params using sys.argv arguments
-if len(sys.argv) > 1:
-    data_params["subjects"] = [sys.argv[1]]
+    # files are claimed from a queue shared with the other tasks of the run
+    work_queue = None
+    if args.queue is not None:
+        work_queue = workqueue.WorkQueue(
+            workqueue.queue_dir(write_params["root"], args.queue),
+            ttl=args.claim_ttl)
 
-# get set of subjects & tasks to run while omitting existing exceptions
-data = load.load_files(data_params)
+    # preprocess every file, spreading them across args.jobs processes
+    try:
+        summary = runner.preprocess_files(
+            data, preprocess_params, ch_type, write_params, jobs=args.jobs,
+            mem_budget=mem_budget, estimates=estimates,
+            work_queue=work_queue, manifest_entries=manifest_entries,
+            hash_input=args.incremental, resume=args.resume, plan=plan,
+            preload=preload, precision=data_params.get("precision"))
+    finally:
+        if work_queue is not None:
+            work_queue.close()
+    runner.print_summary(summary)
+    metrics.write_metrics_csv(summary, write_params["root"])
+    manifest.record(manifest_file, summary, digest)
 
-# for each file in filtered data
-for file in data:
-    # load raw data
-    eeg_obj = mne_bids.read_raw_bids(file)
+    # learn the memory use of the steps for the next estimates
+    if sizes is not None:
+        scheduler.record(model_file, summary, sizes)
 
-    outputs = [None] * len(preprocess_params)
-    # for each pipeline step in user_params, execute with parameters
-    for idx, (func, params) in enumerate(preprocess_params.items()):
-        eeg_obj, outputs[idx] = getattr(preprocess, func)(eeg_obj, **params)
+    if any(result["status"] != "success" for result in summary):
+        sys.exit(1)
 
-        # check if this is the fully preprocessed eeg object
-        final = idx == len(preprocess_params.items()) - 1
-        write.write_eeg_data(eeg_obj, func, file, ch_type, final, output_path)
 
-    # collect annotations of each step
-    outputs.reverse()
-    output = dict(ChainMap(*outputs))
-    write.read_dict_to_json(output, file, ch_type, output_path)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import json
+import os
+import pathlib
+
+import mne_bids
+from mne_bids.config import ALLOWED_PATH_ENTITIES_SHORT
+
+# bump whenever the layout of the stored index changes
+INDEX_VERSION = 2
+
+# top-level folders of a BIDS dataset that never hold raw recordings
+SKIP_DIRS = {"derivatives", "sourcedata", "code"}
+
+# the suffix is kept as a field of its own, newer mne-bids versions no longer
+# list it among the path entities
+ENTITIES = [key for key in ALLOWED_PATH_ENTITIES_SHORT.values()
+            if key != "suffix"]
+
+
+def _read_index(index_path, root):
+    """Read a stored index, discarding it if it belongs to another dataset
+    Parameters
+    ----------
+    index_path: str
+                path of the JSON index
+    root:   str
+            absolute root of BIDS dataset
+
+    Returns
+    ----------
+    dirs:   dict
+            stored directory entries keyed by path relative to root
+    """
+    try:
+        with open(index_path) as fp:
+            index = json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+    if index.get("version") != INDEX_VERSION or index.get("root") != root:
+        return {}
+    return index["dirs"]
+
+
+def _write_index(index_path, root, dirs):
+    """Atomically replace the stored index so concurrent readers never see
+    a partially written file"""
+    dir_name = os.path.dirname(os.path.abspath(index_path))
+    os.makedirs(dir_name, exist_ok=True)
+
+    tmp_path = "{}.{}.tmp".format(index_path, os.getpid())
+    with open(tmp_path, "w") as fp:
+        json.dump({"version": INDEX_VERSION, "root": root, "dirs": dirs}, fp)
+    os.replace(tmp_path, index_path)
+
+
+def _scan_dir(path, rel_path):
+    """List a single directory and parse the BIDS entities of its files
+    Parameters
+    ----------
+    path:   str
+            absolute path of the directory
+    rel_path:   str
+                path of the directory relative to the dataset root
+
+    Returns
+    ----------
+    subdirs:    list
+                names of the child directories
+    files:  list
+            one record of entities, size and mtime per BIDS file
+    """
+    subdirs, files = [], []
+    datatype = os.path.basename(rel_path)
+    if not datatype or datatype.startswith(("sub-", "ses-")):
+        datatype = None
+
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                if rel_path or entry.name not in SKIP_DIRS:
+                    subdirs.append(entry.name)
+                continue
+
+            # only keep BIDS files (sidecar JSONs are ignored like in match)
+            if not entry.name.startswith("sub-") or "." not in entry.name:
+                continue
+            extension = entry.name[entry.name.index("."):]
+            if extension == ".json":
+                continue
+
+            entities = mne_bids.get_entities_from_fname(entry.name,
+                                                        on_error="ignore")
+            stat = entry.stat()
+            record = {key: entities.get(key) for key in ENTITIES}
+            record.update({"path": os.path.join(rel_path, entry.name),
+                           "suffix": entities.get("suffix"),
+                           "datatype": datatype,
+                           "extension": extension,
+                           "size": stat.st_size,
+                           "mtime": stat.st_mtime_ns})
+            files.append(record)
+
+    return sorted(subdirs), files
+
+
+def update_index(root, index_path):
+    """Build or incrementally refresh the on-disk entity index of a dataset
+
+    Only directories whose mtime changed since the index was written are
+    listed again. Directory mtimes change when files are added, removed or
+    renamed, but not when an existing file is rewritten in place.
+
+    Parameters
+    ----------
+    root:   str
+            root of BIDS dataset
+    index_path: str
+                path of the JSON file the index is stored in
+
+    Returns
+    ----------
+    records:    list
+                entities, extension, size and mtime of every BIDS file
+    """
+    root = str(pathlib.Path(root).resolve())
+    old_dirs = _read_index(index_path, root)
+    new_dirs = {}
+    changed = False
+
+    pending = [""]
+    while pending:
+        rel_path = pending.pop()
+        path = os.path.join(root, rel_path)
+        mtime = os.stat(path).st_mtime_ns
+
+        entry = old_dirs.get(rel_path)
+        if entry is None or entry["mtime"] != mtime:
+            subdirs, files = _scan_dir(path, rel_path)
+            entry = {"mtime": mtime, "subdirs": subdirs, "files": files}
+            changed = True
+
+        new_dirs[rel_path] = entry
+        pending.extend(os.path.join(rel_path, d) for d in entry["subdirs"])
+
+    # directories removed since the last run also invalidate the index
+    if changed or set(old_dirs) != set(new_dirs):
+        _write_index(index_path, root, new_dirs)
+
+    records = [f for entry in new_dirs.values() for f in entry["files"]]
+    return sorted(records, key=lambda f: f["path"])
+
+
+def to_bids_path(record, root):
+    """Turn an index record back into the BIDS path BIDSPath.match returns
+    Parameters
+    ----------
+    record: dict
+            index record of a single file
+    root:   str
+            root of BIDS dataset
+
+    Returns
+    ----------
+    bids_path:  mne_bids.BIDSPath
+                path of the indexed file
+    """
+    entities = {key: record[key] for key in ENTITIES}
+    return mne_bids.BIDSPath(root=pathlib.Path(root),
+                             datatype=record["datatype"],
+                             suffix=record["suffix"],
+                             extension=record["extension"],
+                             check=False,
+                             **entities)
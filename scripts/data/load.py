@@ -3,7 +3,9 @@ import mne_bids
 import json
 from mne_bids.config import ALLOWED_DATATYPE_EXTENSIONS
 
-from itertools import product
+from fnmatch import fnmatchcase
+
+from scripts.data import index
 
 
 def load_params(user_param_path):
@@ -12,7 +14,7 @@ def load_params(user_param_path):
         return user_params
 
 
-def _init_subjects(filter_sub, root, ch_type):
+def _init_subjects(filter_sub, root, ch_type, records=None):
     """Initialize collection of files by loading selected subjects
     Parameters
     ----------
@@ -22,12 +24,18 @@ def _init_subjects(filter_sub, root, ch_type):
            root of BIDS dataset
     ch_type: str
              type of BIDS dataset
+    records: list | None
+             records of the on-disk file index. None searches the dataset
+             directly
 
     Returns
     ----------
     files: list
            a list of partially filtered BIDS paths according to subjects
     """
+    if records is not None:
+        return _init_subjects_indexed(filter_sub, root, ch_type, records)
+
     if filter_sub == ["*"]:
         filter_sub = mne_bids.get_entity_vals(root, 'subject')
 
@@ -47,6 +55,23 @@ def _init_subjects(filter_sub, root, ch_type):
     return filered_subjects
 
 
+def _init_subjects_indexed(filter_sub, root, ch_type, records):
+    """Select the files of the chosen subjects from the on-disk file index
+    instead of walking the dataset once per subject"""
+    type_exten = ALLOWED_DATATYPE_EXTENSIONS[ch_type]
+
+    # match get_entity_vals, which ignores empty-room recordings
+    if filter_sub == ["*"]:
+        selected = [r for r in records if r["subject"] != "emptyroom"]
+    else:
+        filter_sub = set(filter_sub)
+        selected = [r for r in records if r["subject"] in filter_sub]
+
+    return [index.to_bids_path(r, root) for r in selected
+            if r["datatype"] == ch_type
+            and r["extension"].lower() in type_exten]
+
+
 def _filter_tasks(filter_tasks, files):
     """Select tasks as defined by user_params
     Parameters
@@ -67,50 +92,74 @@ def _filter_tasks(filter_tasks, files):
     return [f for f in files if f.task in filter_tasks]
 
 
-def _filter_exceptions(subjects, tasks, runs, files, root, ch_type):
+def _entity_matcher(patterns):
+    """Build a membership test for a list of entity values and wildcards
+    Parameters
+    ----------
+    patterns : list | str
+               entity values to match. "*" matches any value (including a
+               missing entity), None (null) matches a missing entity, other
+               values may hold shell-style wildcards
+
+    Returns
+    ----------
+    matches: function
+             returns whether an entity value is matched by any pattern
+    """
+    if isinstance(patterns, str):
+        patterns = [patterns] if patterns else []
+    # user_params may hold numbers, e.g. "runs": [1]
+    missing = None in patterns
+    patterns = [str(p) for p in patterns if p is not None]
+
+    if "*" in patterns:
+        return lambda value: True
+
+    # exact values are looked up in a set, only wildcards are scanned
+    wildcards = [p for p in patterns if any(c in p for c in "*?[")]
+    values = set(patterns) - set(wildcards)
+
+    def matches(value):
+        if value is None:
+            return missing
+        value = str(value)
+        return value in values or any(fnmatchcase(value, p)
+                                      for p in wildcards)
+    return matches
+
+
+def _filter_exceptions(subjects, tasks, runs, files):
     """Remove exceptions as defined by user_params
     Parameters
     ----------
     subjects, tasks, runs : list
-                            a list of subjects, tasks, and runs to be
-                            cartesian multiplied to get omitted files
+                            a list of subjects, tasks, and runs whose
+                            cartesian product is omitted. Values may hold
+                            wildcards, see _entity_matcher
     files: list
            list of partially filtered files according to subject and tasks
-    root: str
-          root of BIDS dataset
-    ch_type: str
-             type of BIDS dataset
 
     Returns
     ----------
     files: list
            a list of fully filtered BIDS paths according to exceptions
     """
-    # get cartesian product of subjects, tasks, and runs
-    exceptions = list(product(subjects, tasks, runs))
-
-    bids_root = pathlib.Path(root)
-    type_exten = ALLOWED_DATATYPE_EXTENSIONS[ch_type]
-    # turn each exception into a BIDS path
-    for i in range(len(exceptions)):
-        file = exceptions[i]
-
-        sub = file[0]
-        task = file[1]
-        run = file[2]
-
-        bids_path = mne_bids.BIDSPath(subject=sub,
-                                      task=task,
-                                      run=run,
-                                      datatype=ch_type,
-                                      root=bids_root)
-        e_files = bids_path.match()
-        e_files_eeg = [f for f in e_files if f.extension.lower() in type_exten]
+    # an empty list in the product means there is nothing to omit
+    if not (subjects and tasks and runs):
+        return files
 
-        exceptions[i] = e_files_eeg[0]
+    match_sub = _entity_matcher(subjects)
+    match_task = _entity_matcher(tasks)
+    # BIDSPath writes numeric runs with two digits, run 1 is "01"
+    if not isinstance(runs, str):
+        runs = [run if run is None or isinstance(run, str)
+                else "{:02}".format(run) for run in runs]
+    match_run = _entity_matcher(runs)
 
-    # remove any file in files that shows up in exceptions and return
-    return [f for f in files if f not in exceptions]
+    # a file is an exception if its subject, task and run are all excluded
+    return [f for f in files
+            if not (match_sub(f.subject) and match_task(f.task)
+                    and match_run(f.run))]
 
 
 def load_files(data_params):
@@ -140,13 +189,17 @@ def load_files(data_params):
     e_tasks = exceptions["tasks"]
     e_runs = exceptions["runs"]
 
+    # read selection from the on-disk file index if one is configured
+    index_path = data_params.get("index")
+    records = index.update_index(root, index_path) if index_path else None
+
     # initialize files by loading selected subjects
-    files = _init_subjects(subjects_sel, root, ch_type)
+    files = _init_subjects(subjects_sel, root, ch_type, records)
 
     # filter tasks
     files = _filter_tasks(tasks_sel, files)
 
     # filter exceptions
-    files = _filter_exceptions(e_sub, e_tasks, e_runs, files, root, ch_type)
+    files = _filter_exceptions(e_sub, e_tasks, e_runs, files)
 
     return files
@@ -0,0 +1,249 @@
+import json
+import os
+import tempfile
+
+import h5py
+import mne
+import numpy as np
+
+from scripts.data.constants import PIPE_NAME, INTERM
+
+# store format, bumped when stages can no longer be read back
+STORE_VERSION = 1
+
+# compression of the sample datasets, readable by any HDF5 library
+COMPRESSION = {"compression": "gzip", "compression_opts": 4,
+               "shuffle": True}
+
+# samples of one channel per chunk of continuous data
+RAW_CHUNK = 2 ** 16
+
+# epochs of one channel per chunk of epoched data
+EPOCHS_CHUNK = 64
+
+
+def store_path(file, datatype, root):
+    """Path of the store of a recording, next to its intermediates"""
+    subj, ses, task, run = file.subject, file.session, file.task, file.run
+
+    dir_path = '{}/derivatives/pipeline_{}/{}/sub-{}/ses-{}/{}/'.format(
+        root, PIPE_NAME, PIPE_NAME + INTERM, subj, ses, datatype)
+
+    return dir_path + 'sub-{}_ses-{}_task-{}_run-{}_proc-{}_{}.h5'.format(
+        subj, ses, task, run, "intermediates", datatype)
+
+
+def _info_bytes(info):
+    """Measurement info of a recording as the bytes of a FIF file"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fname = os.path.join(tmp_dir, "info.fif")
+        mne.io.write_info(fname, info)
+        with open(fname, "rb") as fp:
+            return fp.read()
+
+
+def _read_info(data):
+    """Measurement info from the bytes written by _info_bytes"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fname = os.path.join(tmp_dir, "info.fif")
+        with open(fname, "wb") as fp:
+            fp.write(data)
+        return mne.io.read_info(fname, verbose=False)
+
+
+def _annotations_json(raw):
+    """Annotations of raw, with onsets as set_annotations expects them"""
+    annotations = raw.annotations
+    orig_time = annotations.orig_time
+    # without orig_time, the stored onsets include the time of the first
+    # sample, which set_annotations adds again
+    onset = annotations.onset
+    if orig_time is None:
+        onset = onset - raw._first_time
+    return json.dumps({
+        "onset": onset.tolist(),
+        "duration": annotations.duration.tolist(),
+        "description": annotations.description.tolist(),
+        "orig_time": None if orig_time is None else orig_time.timestamp()})
+
+
+def write_stage(eeg_obj, func, path, fmt="single"):
+    """Write the output of a step into the store of its recording
+
+    Samples are stored compressed, in chunks of one channel, so that any
+    channel subset and time range of a stage can be read on its own (see
+    read_data). A stage written again replaces the earlier one: the store is
+    then rewritten into a new file, as HDF5 does not give back the space of
+    deleted datasets.
+
+    Parameters
+    ----------
+    eeg_obj:    mne.io.Raw | mne.Epochs
+                output of the step
+    func:   str
+            name of the step, the group the stage is written to
+    path:   str
+            store of the recording (see store_path)
+    fmt:    str
+            "single" or "double" precision of the stored samples
+
+    Returns
+    ----------
+    path:   str
+            path of the store
+    """
+    dtype = np.float32 if fmt == "single" else np.float64
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    replaced = False
+    if os.path.exists(path):
+        with h5py.File(path, "r") as store:
+            replaced = func in store
+
+    if not replaced:
+        with h5py.File(path, "a") as store:
+            store.attrs["version"] = STORE_VERSION
+            _write_group(store, eeg_obj, func, dtype)
+        return path
+
+    # the other stages are copied chunk by chunk, without decompressing them
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with h5py.File(path, "r") as old, h5py.File(tmp_path, "w") as store:
+        store.attrs["version"] = STORE_VERSION
+        for name in old:
+            if name != func:
+                old.copy(old[name], store, name=name)
+        _write_group(store, eeg_obj, func, dtype)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _write_group(store, eeg_obj, func, dtype):
+    """Write eeg_obj as the group func of an open store"""
+    epoched = isinstance(eeg_obj, mne.BaseEpochs)
+    if epoched:
+        shape = (len(eeg_obj), len(eeg_obj.ch_names), len(eeg_obj.times))
+        chunks = (min(shape[0], EPOCHS_CHUNK), 1, shape[2])
+        block = EPOCHS_CHUNK
+    else:
+        shape = (len(eeg_obj.ch_names), eeg_obj.n_times)
+        chunks = (1, min(shape[1], RAW_CHUNK))
+        block = RAW_CHUNK
+
+    group = store.create_group(func)
+    group.attrs["kind"] = "epochs" if epoched else "raw"
+    group.attrs["ch_names"] = json.dumps(eeg_obj.ch_names)
+    group.attrs["sfreq"] = eeg_obj.info["sfreq"]
+    group.create_dataset("info", data=np.void(_info_bytes(eeg_obj.info)))
+
+    # written a chunk row at a time, never copying all samples
+    if all(shape):
+        dataset = group.create_dataset("data", shape, dtype,
+                                       chunks=chunks, **COMPRESSION)
+        for start in range(0, shape[0 if epoched else 1], block):
+            stop = start + block
+            if epoched:
+                dataset[start:stop] = eeg_obj.get_data(
+                    item=slice(start, stop))
+            else:
+                dataset[:, start:stop] = eeg_obj.get_data(start=start,
+                                                          stop=stop)
+    else:
+        group.create_dataset("data", shape, dtype)
+
+    if epoched:
+        group.attrs["tmin"] = eeg_obj.tmin
+        group.attrs["event_id"] = json.dumps(eeg_obj.event_id)
+        group.attrs["drop_log"] = json.dumps(eeg_obj.drop_log)
+        group.create_dataset("events", data=eeg_obj.events)
+        group.create_dataset("selection", data=eeg_obj.selection)
+    else:
+        group.attrs["first_samp"] = eeg_obj.first_samp
+        group.attrs["annotations"] = _annotations_json(eeg_obj)
+
+
+def stages(path):
+    """Names of the stages held by a store"""
+    with h5py.File(path, "r") as store:
+        return list(store)
+
+
+def read_data(path, func, picks=None, start=None, stop=None):
+    """Read part of the samples of a stage, without loading the rest
+    Parameters
+    ----------
+    path:   str
+            store of the recording
+    func:   str
+            name of the step
+    picks:  list | None
+            channel names or indices, all channels if None. Channels are
+            returned in their stored order
+    start, stop:    int | None
+                    range of samples of continuous data, or of epochs of
+                    epoched data
+
+    Returns
+    ----------
+    data:   np.ndarray
+            samples as stored, channels x samples or epochs x channels x
+            samples
+    """
+    with h5py.File(path, "r") as store:
+        group = store[func]
+        ch_names = json.loads(group.attrs["ch_names"])
+        if picks is None:
+            picks = slice(None)
+        else:
+            picks = sorted(ch_names.index(pick) if isinstance(pick, str)
+                           else pick for pick in picks)
+        if group.attrs["kind"] == "epochs":
+            return group["data"][start:stop, picks]
+        return group["data"][picks, start:stop]
+
+
+def read_stage(path, func):
+    """Read a stage written by write_stage back into an MNE object
+    Parameters
+    ----------
+    path:   str
+            store of the recording
+    func:   str
+            name of the step
+
+    Returns
+    ----------
+    eeg_obj:    mne.io.Raw | mne.Epochs
+                output of the step
+    """
+    with h5py.File(path, "r") as store:
+        group = store[func]
+        info = _read_info(group["info"][()].tobytes())
+        data = group["data"][()].astype(np.float64)
+
+        if group.attrs["kind"] == "epochs":
+            epochs = mne.EpochsArray(
+                data, info, events=group["events"][()],
+                tmin=group.attrs["tmin"],
+                event_id=json.loads(group.attrs["event_id"]),
+                baseline=None, verbose=False)
+            epochs.selection = group["selection"][()]
+            epochs.drop_log = tuple(tuple(log) for log in
+                                    json.loads(group.attrs["drop_log"]))
+            return epochs
+
+        raw = mne.io.RawArray(data, info, first_samp=group.attrs["first_samp"],
+                              verbose=False)
+        annotations = json.loads(group.attrs["annotations"])
+        raw.set_annotations(mne.Annotations(
+            annotations["onset"], annotations["duration"],
+            annotations["description"], orig_time=annotations["orig_time"]))
+        return raw
+
+
+def remove(path):
+    """Delete a store, e.g. before its recording is processed again"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
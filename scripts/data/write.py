@@ -1,11 +1,36 @@
 import json
+import queue
 import sys
 import os
+import threading
 import mne
+import numpy as np
 
 from scripts.data.constants import PIPE_NAME, INTERM, FINAL
 
 
+def json_default(obj):
+    """Convert numpy values found in step annotations to JSON types"""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("Object of type {} is not JSON serializable".format(
+        type(obj).__name__))
+
+
+def fif_savable(eeg_obj):
+    """eeg_obj, or a float64 copy of single-precision epochs
+
+    MNE saves epochs from float64 data only, whatever the format written.
+    """
+    if isinstance(eeg_obj, mne.BaseEpochs) and eeg_obj.preload and \
+            eeg_obj._data.dtype != np.float64:
+        eeg_obj = eeg_obj.copy()
+        eeg_obj._data = eeg_obj._data.astype(np.float64)
+    return eeg_obj
+
+
 def read_dict_to_json(dict_array, file, datatype, root):
     if dict_array is None:
         print("Invalid dictionary array", file=sys.stderr)
@@ -30,12 +55,12 @@ def read_dict_to_json(dict_array, file, datatype, root):
         subj, ses, task, run, datatype)
 
     with open(dir_path + bids_format, 'w') as file:
-        str = json.dumps(dict_array, indent=4)
+        str = json.dumps(dict_array, indent=4, default=json_default)
         file.seek(0)
         file.write(str)
 
 
-def write_eeg_data(obj, func, file, datatype, final, root):
+def write_eeg_data(obj, func, file, datatype, final, root, fmt="single"):
     """Used to store the modified raw file after each processing step
     Parameters:
     -----------
@@ -55,12 +80,19 @@ def write_eeg_data(obj, func, file, datatype, final, root):
             boolean that determines if eeg object written is the final
     root:   String
             directory from where the data was loaded
+    fmt:    String
+            "single" or "double" precision of the written data
+
+    Returns:
+    ----------
+    raw_savePath:   String
+                    path the object was written to
     """
     # get file metadata
     subj, ses, task, run = file.subject, file.session, file.task, file.run
 
     # determine file extension based on object type
-    obj_type = "_epo.fif" if isinstance(obj, mne.Epochs) else ".fif"
+    obj_type = "_epo.fif" if isinstance(obj, mne.BaseEpochs) else ".fif"
 
     # determine directory child based on feature position
     child_dir = PIPE_NAME + FINAL if final else PIPE_NAME + INTERM
@@ -72,21 +104,68 @@ def write_eeg_data(obj, func, file, datatype, final, root):
     dir_path = '{}/derivatives/pipeline_{}/{}/sub-{}/ses-{}/{}/'.format(
         root, PIPE_NAME, child_dir, subj, ses, datatype)
 
-    dir_section = dir_path.split("/")
-
-    # creates the directory path
-    temp = ""
-    for sec in dir_section:
-        temp += sec + "/"
-        # checks that the directory path doesn't already exist
-        if not os.path.isdir(temp):
-            os.mkdir(temp)  # creates the directory path
+    # creates the directory path, tolerating concurrent writers
+    os.makedirs(dir_path, exist_ok=True)
 
     # saves the raw file in the directory
     raw_savePath = dir_path + 'sub-{}_ses-{}_task-{}_run-{}_proc-{}_{}'.format(
         subj, ses, task, run, func, datatype) + obj_type
 
-    obj.save(raw_savePath, overwrite=True)
+    fif_savable(obj).save(raw_savePath, fmt=fmt, overwrite=True)
+
+    return raw_savePath
+
+
+class BackgroundWriter:
+    """Run write jobs in order on a background thread
+
+    Saving a step output blocks on disk I/O while the next step only needs
+    the CPU, so both can overlap. At most queue_size jobs wait to be written:
+    submit blocks once the queue is full, which bounds the number of data
+    copies held in memory.
+
+    Parameters
+    ----------
+    queue_size: int
+                number of pending jobs before submit blocks
+    """
+
+    _STOP = object()
+
+    def __init__(self, queue_size=1):
+        self._jobs = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is self._STOP:
+                return
+            # skip the remaining jobs once one has failed
+            if self._error is None:
+                func, args = job
+                try:
+                    func(*args)
+                except Exception as error:
+                    self._error = error
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, func, *args):
+        """Queue func(*args), re-raising the error of a failed earlier job"""
+        self._raise()
+        self._jobs.put((func, args))
+
+    def close(self):
+        """Wait for every queued job to finish, re-raising any error"""
+        self._jobs.put(self._STOP)
+        self._thread.join()
+        self._raise()
 
 
 def write_template_params(root, subjects=None, tasks=None,
@@ -125,19 +204,30 @@ def write_template_params(root, subjects=None, tasks=None,
         "subjects": ["*"] if subjects is None else subjects,
         "tasks": ["*"] if tasks is None else tasks,
         "exceptions": exceptions,
-        "channel-type": "eeg"
+        "channel-type": "eeg",
+        "index": None,
+        "preload": None,
+        "precision": None
     }
 
     # set up default preprocess params
     user_params["preprocess"] = {
         "filter_data": {
             "l_freq": 0.3,
-            "h_freq": 40
+            "h_freq": 40,
+            "n_threads": 1,
+            "ica_l_freq": None
         },
         "identify_badchans_raw": {
+            "chunk_duration": None
         },
         "ica_raw": {
-            "montage": "standard_1020"
+            "montage": "standard_1020",
+            "ica_dir": None,
+            "decim": None,
+            "n_components": None,
+            "n_fit_epochs": None,
+            "random_state": None
         },
         "segment_data": {
             "tmin": -0.2,
@@ -151,6 +241,16 @@ def write_template_params(root, subjects=None, tasks=None,
             "preload": None
         },
         "final_reject_epoch": {
+            "ar_dir": None,
+            "pool_size": 10,
+            "pool_epochs": None,
+            "refit": False,
+            "n_interpolate": None,
+            "consensus": None,
+            "cv": 10,
+            "n_jobs": 1,
+            "n_fit_epochs": None,
+            "random_state": None
         },
         "interpolate_data": {
             "mode": "accurate",
@@ -166,7 +266,11 @@ def write_template_params(root, subjects=None, tasks=None,
 
     # set up write_data params
     user_params["output_data"] = {
-        "root": "CMI"
+        "root": "CMI",
+        "cache": None,
+        "intermediates": ["*"],
+        "write_queue": 0,
+        "store": None
     }
 
     if to_file is not None:
@@ -0,0 +1,213 @@
+from scripts.data.write import fif_savable, json_default
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import mne
+
+# bump to invalidate every entry when step implementations change
+CACHE_VERSION = 1
+
+# companion files holding the samples of formats split over several files
+DATA_COMPANIONS = {".set": [".fdt"], ".vhdr": [".eeg", ".vmrk"]}
+
+
+def data_files(file):
+    """Paths of a raw recording and the companion files holding its samples
+    """
+    fpath = str(file.fpath)
+    stem, extension = os.path.splitext(fpath)
+    return [fpath] + [stem + ext
+                      for ext in DATA_COMPANIONS.get(extension.lower(), [])
+                      if os.path.exists(stem + ext)]
+
+
+def file_hash(file, block_size=2 ** 20):
+    """Hash the content of a raw recording, including its data companions
+    Parameters
+    ----------
+    file:   mne_bids.BIDSPath
+            path of the raw recording
+    block_size: int
+                number of bytes read at a time
+
+    Returns
+    ----------
+    digest: str
+            sha256 of the recording, independent of its path and mtime
+    """
+    digest = hashlib.sha256()
+    for path in data_files(file):
+        with open(path, "rb") as fp:
+            for block in iter(lambda: fp.read(block_size), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_keys(input_hash, preprocess_params):
+    """Key of every step: the input content plus all parameters up to it
+    Parameters
+    ----------
+    input_hash: str
+                content hash of the raw recording (see file_hash)
+    preprocess_params:  dict
+                        ordered pipeline steps and their parameters
+
+    Returns
+    ----------
+    keys:   list
+            one key per step
+    """
+    keys = []
+    chain = input_hash
+    for func, params in preprocess_params.items():
+        # normalize parameters so key order and numpy types do not matter
+        payload = json.dumps([CACHE_VERSION, chain, func, params],
+                             sort_keys=True, default=json_default)
+        chain = hashlib.sha256(payload.encode()).hexdigest()
+        keys.append(chain)
+    return keys
+
+
+def _entry_path(cache_root, key):
+    return os.path.join(cache_root, key[:2], key)
+
+
+def get(cache_root, key):
+    """Read a cached step result and mark it as recently used
+    Parameters
+    ----------
+    cache_root: str
+                directory shared by every worker using the cache
+    key:    str
+            key of the step (see cache_keys)
+
+    Returns
+    ----------
+    result: tuple | None
+            (eeg_obj, outputs) with the annotations of every step up to this
+            one, or None if the entry does not exist (anymore)
+    """
+    entry = _entry_path(cache_root, key)
+    try:
+        with open(os.path.join(entry, "outputs.json")) as fp:
+            meta = json.load(fp)
+
+        data_path = os.path.join(entry, meta["data"])
+        if meta["data"].endswith("-epo.fif"):
+            eeg_obj = mne.read_epochs(data_path, preload=True)
+        else:
+            eeg_obj = mne.io.read_raw_fif(data_path, preload=True)
+
+        # update the directory mtime used for least-recently-used eviction
+        os.utime(entry)
+    except Exception:
+        # missing, partially evicted or unreadable entries are cache misses
+        return None
+
+    return eeg_obj, meta["outputs"]
+
+
+def put(cache_root, key, eeg_obj, outputs, max_size=None, fmt="single"):
+    """Store a step result, then evict old entries above max_size
+    Parameters
+    ----------
+    cache_root: str
+                directory shared by every worker using the cache
+    key:    str
+            key of the step (see cache_keys)
+    eeg_obj:    mne.io.Raw | mne.Epochs
+                output of the step
+    outputs:    list
+                annotations of every step up to and including this one
+    max_size:   float | None
+                size limit of the cache in GB, None for no limit
+    fmt:    str
+            "single" or "double" precision of the stored data
+    """
+    entry = _entry_path(cache_root, key)
+    if os.path.isdir(entry):
+        os.utime(entry)
+        return
+
+    # write into a private directory and publish it with a single rename
+    tmp_dir = os.path.join(cache_root, "tmp", "{}.{}".format(key, os.getpid()))
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        data = "data-epo.fif" if isinstance(eeg_obj, mne.BaseEpochs) \
+            else "data_eeg.fif"
+        fif_savable(eeg_obj).save(os.path.join(tmp_dir, data), fmt=fmt,
+                                  overwrite=True)
+        with open(os.path.join(tmp_dir, "outputs.json"), "w") as fp:
+            json.dump({"data": data, "outputs": outputs}, fp,
+                      default=json_default)
+
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        os.rename(tmp_dir, entry)
+    except OSError as error:
+        # another worker published the same entry first
+        if error.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+            raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if max_size is not None:
+        evict(cache_root, max_size)
+
+
+def _entry_size(entry):
+    size = 0
+    for name in os.listdir(entry):
+        size += os.path.getsize(os.path.join(entry, name))
+    return size
+
+
+def evict(cache_root, max_size):
+    """Remove least recently used entries until the cache fits max_size GB
+
+    Only one worker evicts at a time; others skip eviction while the lock is
+    held. Entries are renamed away before deletion so readers never see a
+    half-deleted entry.
+    """
+    lock_path = os.path.join(cache_root, ".lock")
+    with open(lock_path, "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return
+
+        entries = []
+        for prefix in os.listdir(cache_root):
+            prefix_dir = os.path.join(cache_root, prefix)
+            if prefix in ("tmp", "trash") or not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry = os.path.join(prefix_dir, key)
+                try:
+                    entries.append((os.stat(entry).st_mtime,
+                                    _entry_size(entry), entry))
+                except OSError:
+                    continue
+
+        total = sum(size for _, size, _ in entries)
+        limit = max_size * 1e9
+        trash = os.path.join(cache_root, "trash")
+        os.makedirs(trash, exist_ok=True)
+
+        # oldest access first
+        for _, size, entry in sorted(entries):
+            if total <= limit:
+                break
+            doomed = os.path.join(trash, "{}.{}".format(
+                os.path.basename(entry), time.time()))
+            try:
+                os.rename(entry, doomed)
+            except OSError:
+                continue
+            shutil.rmtree(doomed, ignore_errors=True)
+            total -= size
@@ -0,0 +1,139 @@
+from scripts.data.constants import PIPE_NAME, INTERM
+from scripts.data import store
+from scripts.data.write import json_default
+from scripts.pipeline.cache import data_files
+
+import hashlib
+import json
+import os
+
+import mne
+
+
+def _hash(*values):
+    """Stable hash of JSON-serializable values"""
+    payload = json.dumps(values, sort_keys=True, default=json_default)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def chain_hashes(file, preprocess_params, precision=None):
+    """Hash the parameters of every step together with all upstream steps
+    Parameters
+    ----------
+    file:   mne_bids.BIDSPath
+            path of the raw recording
+    preprocess_params:  dict
+                        ordered pipeline steps and their parameters
+    precision:  str | None
+                precision the steps run in (see runner.PRECISIONS)
+
+    Returns
+    ----------
+    hashes: list
+            one hash per step, which changes whenever the input files, the
+            precision or the name or parameters of that step or any step
+            before it change
+    """
+    stat = os.stat(file.fpath)
+    chain = _hash(str(file.fpath), stat.st_size, stat.st_mtime_ns)
+    # the samples of some formats are in companion files (.eeg, .fdt)
+    for path in data_files(file)[1:]:
+        stat = os.stat(path)
+        chain = _hash(chain, path, stat.st_size, stat.st_mtime_ns)
+    # left out by default, so checkpoints of earlier runs stay valid
+    if precision is not None:
+        chain = _hash(chain, precision)
+
+    hashes = []
+    for func, params in preprocess_params.items():
+        chain = _hash(chain, func, params)
+        hashes.append(chain)
+    return hashes
+
+
+def checkpoint_path(file, datatype, root):
+    """Path of the checkpoint file of a recording, next to its intermediates
+    """
+    subj, ses, task, run = file.subject, file.session, file.task, file.run
+
+    dir_path = '{}/derivatives/pipeline_{}/{}/sub-{}/ses-{}/{}/'.format(
+        root, PIPE_NAME, PIPE_NAME + INTERM, subj, ses, datatype)
+
+    return dir_path + 'sub-{}_ses-{}_task-{}_run-{}_checkpoint.json'.format(
+        subj, ses, task, run)
+
+
+def read_checkpoint(path):
+    """Read the completed steps of a checkpoint, [] if there is none"""
+    try:
+        with open(path) as fp:
+            return json.load(fp)["steps"]
+    except (OSError, ValueError, KeyError):
+        return []
+
+
+def write_checkpoint(path, steps):
+    """Atomically store the list of completed steps
+    Parameters
+    ----------
+    path:   str
+            path of the checkpoint file
+    steps:  list
+            one dict per completed step holding its name, chained parameter
+            hash, the path its output was written to and its annotations
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as fp:
+        json.dump({"steps": steps}, fp, indent=4, default=json_default)
+    os.replace(tmp_path, path)
+
+
+def _read_eeg_data(path, func):
+    """Load an intermediate written by write.write_eeg_data or, for a store,
+    the stage func written by store.write_stage"""
+    if path.endswith(".h5"):
+        return store.read_stage(path, func)
+    if path.endswith("_epo.fif"):
+        return mne.read_epochs(path, preload=True)
+    return mne.io.read_raw_fif(path, preload=True)
+
+
+def restore(steps, funcs, hashes):
+    """Find the last intermediate whose upstream parameter chain is unchanged
+    Parameters
+    ----------
+    steps:  list
+            completed steps as stored by write_checkpoint
+    funcs:  list
+            names of the pipeline steps about to run
+    hashes: list
+            chained parameter hashes of those steps (see chain_hashes)
+
+    Returns
+    ----------
+    n_done: int
+            number of leading steps that do not need to run again
+    eeg_obj:    mne.io.Raw | mne.Epochs | None
+                output of the last completed step, None if nothing is reused
+    steps:  list
+            the reusable leading part of steps
+    """
+    # only the leading steps that still match the current chain are valid
+    valid = 0
+    for step, func, step_hash in zip(steps, funcs, hashes):
+        if step["func"] != func or step["hash"] != step_hash:
+            break
+        valid += 1
+
+    # resume from the latest of those whose output can still be read
+    for n_done in range(valid, 0, -1):
+        try:
+            eeg_obj = _read_eeg_data(steps[n_done - 1]["path"],
+                                     steps[n_done - 1]["func"])
+        except Exception:
+            continue
+        return n_done, eeg_obj, steps[:n_done]
+
+    return 0, None, []
@@ -0,0 +1,163 @@
+from scripts.data.constants import PIPE_NAME
+from scripts.data.write import json_default
+from scripts.pipeline.cache import data_files, file_hash
+
+import collections
+import datetime
+import fcntl
+import hashlib
+import json
+import os
+
+
+def manifest_path(root):
+    """Path of the run manifest of the derivatives under root"""
+    return os.path.join(root, "derivatives", "pipeline_" + PIPE_NAME,
+                        "manifest.json")
+
+
+def params_hash(preprocess_params, **options):
+    """Hash of everything besides the input that the outputs depend on
+    Parameters
+    ----------
+    preprocess_params:  dict
+                        ordered pipeline steps and their parameters
+    options:    dict
+                other settings changing the outputs, e.g. the precision
+
+    Returns
+    ----------
+    digest: str
+            sha1 of the parameters, independent of the order of the keys
+    """
+    payload = json.dumps([list(preprocess_params.items()), options],
+                         sort_keys=True, default=json_default)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def input_state(file):
+    """Total size and latest mtime of a recording and its data companions"""
+    stats = [os.stat(path) for path in data_files(file)]
+    return {"size": sum(stat.st_size for stat in stats),
+            "mtime": max(stat.st_mtime for stat in stats)}
+
+
+def file_state(file, entry=None, hash_content=True):
+    """Size, mtime and content hash of a recording, taken before it is
+    processed. The hash of the manifest entry is reused when the size and
+    mtime are unchanged. Otherwise the content is hashed, or the hash left
+    None without hash_content"""
+    state = input_state(file)
+    if entry and entry.get("hash") and \
+            state == {"size": entry.get("size"), "mtime": entry.get("mtime")}:
+        state["hash"] = entry["hash"]
+    else:
+        state["hash"] = file_hash(file) if hash_content else None
+    return state
+
+
+def read_manifest(path):
+    """Read the manifest, by file name, {} if there is none"""
+    try:
+        with open(path) as fp:
+            return json.load(fp)["files"]
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def changed_files(files, manifest, digest):
+    """Select the recordings to process in an incremental run
+
+    The content of a file is only hashed when its size or mtime differs from
+    the manifest, so an unchanged dataset is checked from the file system
+    metadata alone. Files found unchanged after hashing are returned with
+    their new size and mtime, to be written back with write_entries. Files
+    recorded without a hash count as changed once their size or mtime
+    differs.
+
+    Parameters
+    ----------
+    files:  list
+            BIDS paths as returned by load.load_files
+    manifest:   dict
+                entries of the recordings processed so far (read_manifest)
+    digest: str
+            hash of the current parameters (params_hash)
+
+    Returns
+    ----------
+    selected:   list
+                files that are new, whose parameters changed, or whose
+                content changed, in their original order
+    reasons:    collections.Counter
+                number of files by reason: new, parameters, changed,
+                unchanged
+    touched:    dict
+                updated manifest entries of the files whose mtime changed
+                but not their content, by file name
+    """
+    selected, reasons, touched = [], collections.Counter(), {}
+    for file in files:
+        entry = manifest.get(file.basename)
+        if entry is None:
+            reason = "new"
+        elif entry.get("params") != digest:
+            reason = "parameters"
+        elif input_state(file) == {"size": entry.get("size"),
+                                   "mtime": entry.get("mtime")}:
+            reason = "unchanged"
+        # recorded without a hash, the content cannot be compared
+        elif entry.get("hash") is None or file_hash(file) != entry["hash"]:
+            reason = "changed"
+        else:
+            reason = "unchanged"
+            touched[file.basename] = dict(entry, **input_state(file))
+
+        reasons[reason] += 1
+        if reason != "unchanged":
+            selected.append(file)
+    return selected, reasons, touched
+
+
+def write_entries(path, entries):
+    """Add or replace entries of the manifest
+
+    The manifest is locked while it is updated, so that the tasks of a
+    sharded or queued run can all record their files.
+    """
+    if not entries:
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = read_manifest(path)
+        manifest.update(entries)
+
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w") as fp:
+            json.dump({"files": manifest}, fp, indent=4)
+        os.replace(tmp_path, path)
+
+
+def record(path, summary, digest):
+    """Add the recordings processed successfully to the manifest, except
+    those whose results wait for a shared model (runner.preprocess_files)
+    Parameters
+    ----------
+    path:   str
+            manifest file (manifest_path)
+    summary:    list
+                status dictionaries returned by runner.preprocess_files, with
+                the state of every input taken before it was processed
+                (file_state)
+    digest: str
+            hash of the parameters the files were processed with
+    """
+    date = datetime.datetime.now().isoformat(timespec="seconds")
+    write_entries(path, {result["file"]: dict(result["input"], params=digest,
+                                              date=date)
+                         for result in summary
+                         if result["status"] == "success"
+                         and result.get("input")
+                         and not result.get("provisional")})
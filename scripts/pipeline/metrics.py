@@ -0,0 +1,129 @@
+from scripts.data.constants import PIPE_NAME
+
+from contextlib import contextmanager
+
+import csv
+import datetime
+import os
+import resource
+import sys
+import time
+
+# columns of the dataset-level metrics table
+CSV_FIELDS = ["date", "file", "step", "wall_time", "cpu_time", "peak_rss",
+              "write_time"]
+
+
+def _reset_peak_rss():
+    """Reset the peak resident set size of this process (Linux only)
+
+    Returns
+    ----------
+    reset:  bool
+            False if the kernel does not support resetting the peak, in which
+            case peaks are those of the whole process so far
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss():
+    """Peak resident set size of this process in MB"""
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    # ru_maxrss is in bytes on macOS and in kB elsewhere
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2 ** 20 if sys.platform == "darwin" else max_rss / 1024
+
+
+def rss():
+    """Current resident set size of this process in MB, 0 if unknown"""
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0
+
+
+@contextmanager
+def measure(metrics, name):
+    """Record wall time, CPU time and peak RSS of a block under metrics[name]
+
+    Times of blocks measured several times under the same name add up and
+    their peak RSS is the largest one.
+
+    Parameters
+    ----------
+    metrics:    dict
+                metrics of the file being processed
+    name:   str
+            name of the measured block, e.g. a pipeline step
+    """
+    _reset_peak_rss()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        entry = metrics.setdefault(name, {})
+        entry["wall_time"] = entry.get("wall_time", 0) + \
+            time.perf_counter() - wall
+        entry["cpu_time"] = entry.get("cpu_time", 0) + \
+            time.process_time() - cpu
+        entry["peak_rss"] = max(entry.get("peak_rss", 0), peak_rss())
+
+
+def add_write_time(metrics, name, seconds):
+    """Add the time spent writing the output of a step to its metrics"""
+    entry = metrics.setdefault(name, {})
+    entry["write_time"] = entry.get("write_time", 0) + seconds
+
+
+def write_metrics_csv(summary, root):
+    """Append the per-step metrics of every processed file to a dataset CSV
+    Parameters
+    ----------
+    summary:    list
+                status dictionaries returned by runner.preprocess_files
+    root:   str
+            output root, the table is written to
+            derivatives/pipeline_PEPPER/metrics.csv
+
+    Returns
+    ----------
+    csv_path:   str
+                path of the metrics table
+    """
+    dir_path = os.path.join(root, "derivatives", "pipeline_" + PIPE_NAME)
+    os.makedirs(dir_path, exist_ok=True)
+    csv_path = os.path.join(dir_path, "metrics.csv")
+
+    date = datetime.datetime.now().isoformat(timespec="seconds")
+    rows = []
+    for result in summary:
+        for step, values in (result.get("metrics") or {}).items():
+            row = {"date": date, "file": result["file"], "step": step}
+            row.update(values)
+            rows.append(row)
+
+    # append so that runs over other subjects or shards keep their rows
+    new_file = not os.path.exists(csv_path)
+    with open(csv_path, "a", newline="") as fp:
+        writer = csv.DictWriter(fp, fieldnames=CSV_FIELDS)
+        if new_file:
+            writer.writeheader()
+        writer.writerows(rows)
+
+    return csv_path
@@ -0,0 +1,224 @@
+from scripts.preprocess import preprocess
+
+import collections
+
+import mne
+
+# what each pipeline step does with the object it receives
+#   in_place:   modifies the object it receives and returns it, otherwise
+#               always returns a new object, also when it fails
+#   changes_data:   changes the samples, not only the measurement info
+#   needs_loaded:   reads the data of every epoch
+#   random_access:  reads the data repeatedly in no fixed order, too slowly
+#                   from a memory-mapped file
+STEP_SPECS = {
+    "filter_data": {"in_place": True, "changes_data": True,
+                    "needs_loaded": True, "random_access": False},
+    "identify_badchans_raw": {"in_place": True, "changes_data": False,
+                              "needs_loaded": True, "random_access": False},
+    "ica_raw": {"in_place": True, "changes_data": True,
+                "needs_loaded": True, "random_access": True},
+    "segment_data": {"in_place": False, "changes_data": False,
+                     "needs_loaded": False, "random_access": False},
+    "final_reject_epoch": {"in_place": False, "changes_data": True,
+                           "needs_loaded": True, "random_access": True},
+    "interpolate_data": {"in_place": True, "changes_data": True,
+                         "needs_loaded": True, "random_access": False},
+    "reref_raw": {"in_place": True, "changes_data": True,
+                  "needs_loaded": True, "random_access": False},
+}
+
+# assumed for steps without a spec
+DEFAULT_SPEC = {"in_place": True, "changes_data": True, "needs_loaded": True,
+                "random_access": True}
+
+# steps that turn a continuous recording into epochs
+EPOCHING_STEPS = {"segment_data"}
+
+
+def select_steps(selection, preprocess_params):
+    """Names of the steps picked by a list of step names, ["*"] for all"""
+    if selection == ["*"]:
+        return set(preprocess_params)
+    return set(selection)
+
+
+def step_spec(func):
+    """Inputs and side effects of a pipeline step"""
+    return STEP_SPECS.get(func, DEFAULT_SPEC)
+
+
+def _written_steps(preprocess_params, write_params):
+    """Steps whose output is saved, as an intermediate or in the cache"""
+    funcs = list(preprocess_params)
+    written = select_steps(write_params.get("intermediates", ["*"]),
+                           preprocess_params) | set(funcs[-1:])
+    cache_params = write_params.get("cache")
+    if cache_params:
+        written |= select_steps(cache_params.get("steps", ["*"]),
+                                preprocess_params)
+    return written
+
+
+def make_plan(preprocess_params, write_params, lazy=False, ica_copy=False):
+    """Plan the execution of the pipeline steps, removing redundant work
+
+    - the output of a step is copied for the background writer only if it is
+      saved and the next step modifies it in place
+    - lazy epochs of segment_data are preloaded when the next step reads them
+      all anyway, instead of being read twice
+    - with ica_copy, the 1 Hz high-pass ica_raw trains on is made in the
+      filter_data pass when only steps that leave the samples unchanged run
+      in between, unless the recording is memory-mapped
+    - a memory-mapped recording is loaded into memory before the first step
+      that needs random access to it
+
+    Parameters
+    ----------
+    preprocess_params:  dict
+                        ordered pipeline steps and their parameters
+    write_params:   dict
+                    output_data section of user_params
+    lazy:   bool
+            recordings are read into memory-mapped files (load_data preload)
+    ica_copy:   bool
+                allow filter_data to make the copy ica_raw trains on, which
+                holds a second copy of the recording until ica_raw runs
+
+    Returns
+    ----------
+    plan:   list
+            one dict per step: func, params to run it with, snapshot (copy
+            its output before the next step runs), materialize (load
+            memory-mapped data into memory before the step), notes
+            describing the changes made by the plan and the work they save
+    """
+    written = _written_steps(preprocess_params, write_params)
+    background = bool(write_params.get("write_queue", 0))
+
+    plan = [{"func": func, "params": dict(params), "snapshot": False,
+             "materialize": False, "notes": [],
+             "saves": collections.Counter()}
+            for func, params in preprocess_params.items()]
+
+    if lazy:
+        _plan_materialize(plan)
+
+    for idx, step in enumerate(plan[:-1]):
+        func, params = step["func"], step["params"]
+        next_func = plan[idx + 1]["func"]
+
+        # without a plan, every output but the last is copied for the writer
+        if background:
+            step["snapshot"] = func in written and \
+                step_spec(next_func)["in_place"]
+            step["saves"]["copies"] += not step["snapshot"]
+
+        preload = params.get("preload")
+        if func == "segment_data" and not isinstance(preload, str) and \
+                preload is not True and step_spec(next_func)["needs_loaded"]:
+            params["preload"] = True
+            step["notes"].append("preload epochs, {} reads them all"
+                                 .format(next_func))
+            step["saves"]["epoch reads"] += 1
+
+        # the copy would take the memory saved by memory-mapping
+        if ica_copy and func == "filter_data" and \
+                params.get("ica_l_freq") is None and not lazy:
+            _plan_ica_input(plan, idx)
+
+    return plan
+
+
+def _plan_materialize(plan):
+    """Load memory-mapped recordings before the first step that needs random
+    access to them, if it runs before epoching"""
+    for step in plan:
+        if step_spec(step["func"])["random_access"]:
+            step["materialize"] = True
+            step["notes"].append("load the memory-mapped recording")
+            return
+        if step["func"] in EPOCHING_STEPS:
+            return
+
+
+def _plan_ica_input(plan, idx):
+    """Make the ICA training copy in the filter_data pass at plan[idx] if
+    ica_raw follows with the same samples"""
+    for step in plan[idx + 1:]:
+        if step["func"] == "ica_raw":
+            plan[idx]["params"]["ica_l_freq"] = preprocess.ICA_L_FREQ
+            plan[idx]["notes"].append(
+                "also high-pass a copy at {} Hz for ica_raw, held in "
+                "memory until then".format(
+                    preprocess.ICA_L_FREQ))
+            step["notes"].append("train on the copy made by filter_data")
+            step["saves"]["filter passes"] += 1
+            return
+
+        spec = step_spec(step["func"])
+        if not spec["in_place"] or spec["changes_data"]:
+            return
+
+
+def data_bytes(file):
+    """Size in memory of the samples of a recording, read from its header"""
+    try:
+        raw = mne.io.read_raw(file.fpath, preload=False, verbose=False)
+    except Exception:
+        return 0
+    return len(raw.ch_names) * raw.n_times * 8
+
+
+def estimate_savings(plan, files=None):
+    """Work avoided by the plan compared to running the steps as listed
+    Parameters
+    ----------
+    plan:   list
+            execution plan returned by make_plan
+    files:  list | None
+            BIDS paths of the recordings to process. Their headers are read
+            to estimate the bytes not copied, which is skipped if None
+
+    Returns
+    ----------
+    savings:    dict
+                per file: copies of the data, filter passes over the data and
+                reads of all epochs avoided. In total: bytes not copied,
+                estimated from the size of the raw recordings
+    """
+    savings = collections.Counter({"copies": 0, "filter passes": 0,
+                                   "epoch reads": 0})
+    for step in plan:
+        savings.update(step["saves"])
+
+    savings = dict(savings)
+    if files is not None:
+        savings["copied bytes"] = savings["copies"] and \
+            savings["copies"] * sum(data_bytes(file) for file in files)
+    return savings
+
+
+def print_plan(plan, savings=None, verbose=True):
+    """Print the plan and the estimated savings
+
+    verbose=False only prints the savings.
+    """
+    if verbose:
+        print("Execution plan:")
+        for idx, step in enumerate(plan):
+            notes = list(step["notes"])
+            if step["snapshot"]:
+                notes.append("copy output for the background writer")
+            print("  {} {:<22}{}".format(idx + 1, step["func"],
+                                         "; ".join(notes)))
+
+    if savings is not None:
+        total = ""
+        if "copied bytes" in savings:
+            total = " (about {:.0f} MB not copied in total)".format(
+                savings["copied bytes"] / 2 ** 20)
+        print("Plan saves per file: {} data copies, {} filter passes, {} "
+              "epoch reads{}".format(savings["copies"],
+                                     savings["filter passes"],
+                                     savings["epoch reads"], total))
@@ -0,0 +1,513 @@
+from scripts.data import store, write
+from scripts.pipeline import (cache, checkpoint, manifest, metrics, planner,
+                              scheduler)
+from scripts.preprocess import preprocess
+
+from collections import ChainMap
+from concurrent.futures import (FIRST_COMPLETED, Future,
+                                ProcessPoolExecutor, as_completed, wait)
+
+import mne
+import mne_bids
+import numpy as np
+import os
+import sys
+import tempfile
+import time
+import traceback
+
+
+def _file_params(params, file):
+    """Fill {entity} placeholders of string parameters with the BIDS entities
+    of file, e.g. "autoreject/task-{task}" becomes "autoreject/task-rest"
+    """
+    entities = {key: value for key, value in file.entities.items()
+                if value is not None}
+    return {key: value.format_map(entities)
+            if isinstance(value, str) and "{" in value else value
+            for key, value in params.items()}
+
+
+def _read_raw(file, preload=None):
+    """Read a recording, memory-mapped in a file of directory preload if
+    given. The file is removed at once, its space is freed with the data"""
+    if preload is None:
+        return mne_bids.read_raw_bids(file)
+
+    os.makedirs(preload, exist_ok=True)
+    fd, fname = tempfile.mkstemp(suffix=".dat", dir=preload)
+    os.close(fd)
+    try:
+        return mne_bids.read_raw_bids(file, extra_params={"preload": fname})
+    finally:
+        os.unlink(fname)
+
+
+def _materialize(eeg_obj):
+    """Load the memory-mapped data of a raw recording into memory"""
+    if isinstance(eeg_obj, mne.io.BaseRaw) and \
+            isinstance(eeg_obj._data, np.memmap):
+        eeg_obj._data = np.array(eeg_obj._data)
+
+
+# in-memory type and FIF format of each load_data precision
+PRECISIONS = {"single": (np.float32, "single"),
+              "double": (np.float64, "double")}
+
+
+def set_precision(eeg_obj, precision):
+    """Convert the data of eeg_obj in place to "single" or "double" precision
+
+    Memory-mapped data and epochs that are not loaded are left as they are.
+    None leaves the data unchanged.
+    """
+    data = getattr(eeg_obj, "_data", None)
+    if precision is None or data is None or isinstance(data, np.memmap):
+        return eeg_obj
+
+    dtype = PRECISIONS[precision][0]
+    if data.dtype != dtype and not np.iscomplexobj(data):
+        eeg_obj._data = data.astype(dtype)
+    return eeg_obj
+
+
+def _load(file, funcs, hashes, ckpt_path, resume):
+    """Restore the completed steps of a previous run if asked to"""
+    n_done, eeg_obj, steps = 0, None, []
+    if resume:
+        n_done, eeg_obj, steps = checkpoint.restore(
+            checkpoint.read_checkpoint(ckpt_path), funcs, hashes)
+        if n_done:
+            print("Resuming {} after {}".format(file.basename,
+                                                funcs[n_done - 1]))
+    return n_done, eeg_obj, steps, [step["output"] for step in steps]
+
+
+def preprocess_file(file, preprocess_params, ch_type, write_params,
+                    resume=False, plan=None, preload=None, precision=None,
+                    input_hash=None):
+    """Run every pipeline step of user_params on a single BIDS file
+    Parameters
+    ----------
+    file:   mne_bids.BIDSPath
+            path of the raw recording to preprocess
+    preprocess_params:  dict
+                        ordered pipeline steps and their parameters
+    ch_type:    str
+                type of BIDS dataset
+    write_params:   dict
+                    output_data section of user_params: output root, result
+                    cache, intermediates to persist and write queue size
+    resume: bool
+            continue from the last intermediate written by a previous run
+            whose upstream parameters are unchanged
+    plan:   list | None
+            execution plan of planner.make_plan, made here if None
+    preload:    str | None
+                directory the recording is memory-mapped from instead of
+                being read into memory
+    precision:  str | None
+                "single" keeps the data in float32 between steps and writes
+                it in single precision, "double" keeps float64 and writes
+                double precision. None keeps float64 and writes single
+    input_hash: str | None
+                content hash of the recording (cache.file_hash), computed
+                here for the cache if None
+
+    Returns
+    ----------
+    output: dict
+            annotations collected from every pipeline step, with the wall
+            time, CPU time, peak RSS and write time of each step, the loading
+            of the input and the final wait for pending writes under "Metrics"
+    """
+    output_path = write_params["root"]
+    cache_params = write_params.get("cache")
+    persisted = planner.select_steps(
+        write_params.get("intermediates", ["*"]), preprocess_params)
+
+    funcs = list(preprocess_params)
+    if plan is None:
+        plan = planner.make_plan(preprocess_params, write_params,
+                                 lazy=preload is not None)
+    hashes = checkpoint.chain_hashes(file, preprocess_params, precision)
+    ckpt_path = checkpoint.checkpoint_path(file, ch_type, output_path)
+    fmt = PRECISIONS[precision][1] if precision else "single"
+
+    # intermediates go to a single HDF5 file per recording instead
+    store_file = None
+    if write_params.get("store") is not None:
+        if write_params["store"] != "hdf5":
+            raise ValueError("unknown store {!r}, use \"hdf5\" or "
+                             "null".format(write_params["store"]))
+        store_file = store.store_path(file, ch_type, output_path)
+
+    if cache_params:
+        cache_root = cache_params["root"]
+        max_size = cache_params.get("max_size")
+        cached = planner.select_steps(cache_params.get("steps", ["*"]),
+                                      preprocess_params)
+        # results computed in another precision differ slightly
+        if input_hash is None:
+            input_hash = cache.file_hash(file)
+        if precision:
+            input_hash += ":" + precision
+        keys = cache.cache_keys(input_hash, preprocess_params)
+
+    def persist(eeg_obj, idx, outputs, write_data=True):
+        """Write the result of a step and record it in the checkpoint"""
+        func = funcs[idx]
+        final = idx == len(funcs) - 1
+
+        start = time.perf_counter()
+        path = None
+        if final or func in persisted:
+            # forget this step before its output is overwritten
+            checkpoint.write_checkpoint(ckpt_path, steps)
+            if store_file is not None and not final:
+                path = store.write_stage(eeg_obj, func, store_file, fmt=fmt)
+            else:
+                path = write.write_eeg_data(eeg_obj, func, file, ch_type,
+                                            final, output_path, fmt=fmt)
+
+        # results of steps waiting for a shared model (see
+        # preprocess_files) are neither resumed from nor cached
+        provisional = any(output.get("provisional")
+                          for output in outputs[:idx + 1])
+        steps.append({"func": func,
+                      "hash": None if provisional else hashes[idx],
+                      "path": path, "output": outputs[idx]})
+        checkpoint.write_checkpoint(ckpt_path, steps)
+
+        if write_data and cache_params and func in cached and \
+                not provisional:
+            cache.put(cache_root, keys[idx], eeg_obj, outputs, max_size,
+                      fmt=fmt)
+        metrics.add_write_time(step_metrics, func,
+                               time.perf_counter() - start)
+
+    step_metrics = {}
+    with metrics.measure(step_metrics, "load"):
+        n_done, eeg_obj, steps, outputs = _load(file, funcs, hashes,
+                                                ckpt_path, resume)
+
+    # look for the latest step already computed for identical input data
+    if cache_params:
+        for idx in range(len(funcs) - 1, n_done - 1, -1):
+            hit = cache.get(cache_root, keys[idx]) \
+                if funcs[idx] in cached else None
+            if hit is None:
+                continue
+
+            print("Cache hit for {} at {}".format(file.basename, funcs[idx]))
+            eeg_obj, outputs = hit
+            n_done = idx + 1
+
+            # write the reused result like a computed one
+            steps = [{"func": func, "hash": hashes[i], "path": None,
+                      "output": outputs[i]} for i, func in enumerate(funcs)
+                     if i < idx]
+            persist(eeg_obj, idx, outputs, write_data=False)
+            break
+
+    # load raw data
+    if eeg_obj is None:
+        with metrics.measure(step_metrics, "load"):
+            eeg_obj = _read_raw(file, preload)
+    set_precision(eeg_obj, precision)
+
+    # stages of an earlier run would only take space in the store
+    if store_file is not None and n_done == 0:
+        store.remove(store_file)
+
+    # hand saves to a background thread so computation can continue
+    queue_size = write_params.get("write_queue", 0)
+    writer = write.BackgroundWriter(queue_size) if queue_size else None
+
+    try:
+        # for each pipeline step in user_params, execute with parameters
+        for idx in range(n_done, len(funcs)):
+            func, params = funcs[idx], plan[idx]["params"]
+            with metrics.measure(step_metrics, func):
+                if plan[idx]["materialize"]:
+                    _materialize(eeg_obj)
+                eeg_obj, output = getattr(preprocess, func)(
+                    eeg_obj, **_file_params(params, file))
+                set_precision(eeg_obj, precision)
+            outputs.append(output)
+
+            if writer is None:
+                persist(eeg_obj, idx, outputs)
+                continue
+
+            # save a snapshot if the next step modifies eeg_obj in place
+            snapshot = eeg_obj.copy() if plan[idx]["snapshot"] else eeg_obj
+            writer.submit(persist, snapshot, idx, list(outputs))
+    finally:
+        if writer is not None:
+            with metrics.measure(step_metrics, "write"):
+                writer.close()
+
+    # collect annotations of each step
+    outputs = list(reversed(outputs))
+    output = dict(ChainMap(*outputs))
+    output["Metrics"] = step_metrics
+    write.read_dict_to_json(output, file, ch_type, output_path)
+
+    return output
+
+
+def _run_file(file, preprocess_params, ch_type, write_params,
+              manifest_entry=None, hash_input=False, **options):
+    """Preprocess a file and report its status instead of raising
+
+    The state of the input is taken before it is processed, reusing the hash
+    of its manifest_entry (see manifest.file_state) when unchanged. The
+    content is only hashed with hash_input or a result cache, whose key the
+    hash then is.
+
+    Returns
+    ----------
+    summary:    dict
+                file name, status, elapsed time, error (if any), per-step
+                metrics, the memory of the worker in MB before it read the
+                file, the state of the input (manifest.file_state) and the
+                shared model the results wait for, if any
+    """
+    base_rss = metrics.rss()
+    start = time.perf_counter()
+    error, output, state = None, {}, None
+    try:
+        state = manifest.file_state(
+            file, manifest_entry,
+            hash_content=hash_input or bool(write_params.get("cache")))
+        if state["hash"] is not None:
+            options["input_hash"] = state["hash"]
+        output = preprocess_file(file, preprocess_params, ch_type,
+                                 write_params, **options)
+    except Exception:
+        error = traceback.format_exc()
+        print(error, file=sys.stderr)
+
+    return {"file": file.basename,
+            "status": "failed" if error else "success",
+            "elapsed": time.perf_counter() - start,
+            "error": error,
+            "metrics": output.get("Metrics"),
+            "base_rss": base_rss,
+            "input": state,
+            "provisional": output.get("provisional")}
+
+
+def _init_worker():
+    """Keep BLAS from spawning one thread per core inside every worker"""
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(limits=1)
+
+
+def preprocess_files(files, preprocess_params, ch_type, write_params, jobs=1,
+                     mem_budget=None, estimates=None, work_queue=None,
+                     manifest_entries=None, **options):
+    """Run the pipeline over a collection of files
+    Parameters
+    ----------
+    files:  list
+            list of BIDS paths as returned by load.load_files
+    preprocess_params:  dict
+                        ordered pipeline steps and their parameters
+    ch_type:    str
+                type of BIDS dataset
+    write_params:   dict
+                    output_data section of user_params
+    jobs:   int
+            number of worker processes. 1 runs every file in this process
+    mem_budget: float | None
+                memory in MB the files processed at the same time may use
+                together. Files are started, largest first, only while their
+                estimated peak memory fits in what is left
+    estimates:  list | None
+                estimated peak memory in MB of every file, required with
+                mem_budget (see scheduler.estimate_mb). Files are started
+                largest first; without mem_budget any measure of their size
+                sets the order
+    work_queue: workqueue.WorkQueue | None
+                queue shared with other tasks: only the files this task
+                claims are processed, until every file is done
+    manifest_entries:   dict | None
+                        manifest entries by file name (see
+                        manifest.read_manifest), each file only receives its
+                        own
+    options:    dict
+                keyword arguments passed on to preprocess_file, and
+                hash_input to hash the content of every input (see
+                _run_file)
+
+    Returns
+    ----------
+    summary:    list
+                one status dictionary per file processed, in order of
+                completion
+
+    Steps may mark their output "provisional" with the path of a model
+    shared between recordings that did not exist yet (final_reject_epoch
+    while the AutoReject pool fills up). Once every file is done, those
+    whose model now exists are processed again, resuming before that step.
+    """
+    entries = manifest_entries or {}
+    summary = _process_files(files, preprocess_params, ch_type, write_params,
+                             jobs, mem_budget, estimates, work_queue, entries,
+                             **options)
+
+    redo = [idx for idx, file in enumerate(files)
+            if any(result["file"] == file.basename
+                   and result.get("provisional")
+                   and os.path.exists(result["provisional"])
+                   for result in summary)]
+    if not redo:
+        return summary
+
+    print("Processing {} file(s) again with the shared models fitted "
+          "meanwhile".format(len(redo)))
+    again = _process_files(
+        [files[idx] for idx in redo], preprocess_params, ch_type,
+        write_params, jobs, mem_budget,
+        None if estimates is None else [estimates[idx] for idx in redo],
+        None, entries, **dict(options, resume=True))
+    again = {result["file"]: result for result in again}
+    for result in summary:
+        if result["file"] in again:
+            elapsed = result["elapsed"]
+            result.update(again[result["file"]])
+            result["elapsed"] += elapsed
+    return summary
+
+
+def _process_files(files, preprocess_params, ch_type, write_params, jobs,
+                   mem_budget, estimates, work_queue, entries, **options):
+    """Run the pipeline once over files, see preprocess_files"""
+    args = (preprocess_params, ch_type, write_params)
+    admit = mem_budget is not None or work_queue is not None
+
+    def file_options(file):
+        # only the entry of the file is sent to its worker
+        return dict(options, manifest_entry=entries.get(file.basename))
+
+    if jobs <= 1:
+        if admit:
+            def run_now(file):
+                future = Future()
+                future.set_result(_run_file(file, *args,
+                                            **file_options(file)))
+                return future
+            return _admit_files(run_now, files, 1, mem_budget, estimates,
+                                work_queue)
+        return [_run_file(file, *args, **file_options(file))
+                for file in files]
+
+    summary = []
+    with ProcessPoolExecutor(max_workers=jobs,
+                             initializer=_init_worker) as executor:
+        if admit:
+            return _admit_files(
+                lambda file: executor.submit(_run_file, file, *args,
+                                             **file_options(file)),
+                files, jobs, mem_budget, estimates, work_queue)
+
+        futures = {executor.submit(_run_file, file, *args,
+                                   **file_options(file)): file
+                   for file in files}
+        # collect results as soon as any worker is done
+        for future in as_completed(futures):
+            summary.append(_result(future, futures[future]))
+
+    return summary
+
+
+def _result(future, file):
+    """Status of a finished file, also if its worker died"""
+    try:
+        result = future.result()
+    except Exception:
+        # worker died (e.g. killed by the OOM killer)
+        error = traceback.format_exc()
+        result = {"file": file.basename,
+                  "status": "failed",
+                  "elapsed": float("nan"),
+                  "error": error,
+                  "metrics": None}
+    print("{}: {} ({:.1f} s)".format(result["file"], result["status"],
+                                     result["elapsed"]))
+    return result
+
+
+def _admit_files(submit, files, jobs, mem_budget, estimates, work_queue):
+    """Start files with submit while fewer than jobs run, their memory
+    estimates fit mem_budget and, with a work_queue, this task claims them"""
+    pending = list(range(len(files)))
+    if estimates is not None:
+        pending.sort(key=lambda idx: -estimates[idx])
+    futures, summary = {}, []
+    claimed, next_poll = set(), 0.
+    while pending or futures:
+        # files claimed by other tasks are tried again once per poll, until
+        # they are done or their claims expire
+        if work_queue is not None and time.monotonic() >= next_poll:
+            claimed, next_poll = set(), time.monotonic() + work_queue.poll
+
+        candidates = [idx for idx in pending if idx not in claimed]
+        while candidates and len(futures) < jobs:
+            idx = candidates[0] if mem_budget is None else \
+                scheduler.next_file(estimates, candidates,
+                                    list(futures.values()), mem_budget)
+            if idx is None:
+                break
+            candidates.remove(idx)
+            if work_queue is not None and not work_queue.claim(files[idx]):
+                if work_queue.is_done(files[idx]):
+                    pending.remove(idx)
+                else:
+                    claimed.add(idx)
+                continue
+            pending.remove(idx)
+            futures[submit(files[idx])] = idx
+
+        if not futures:
+            # the files left are processed by other tasks
+            if pending:
+                time.sleep(max(next_poll - time.monotonic(), 0))
+            continue
+
+        done, _ = wait(futures, return_when=FIRST_COMPLETED,
+                       timeout=None if work_queue is None
+                       else work_queue.poll)
+        for future in done:
+            idx = futures.pop(future)
+            result = _result(future, files[idx])
+            if work_queue is not None:
+                work_queue.complete(files[idx], result["status"])
+            summary.append(result)
+
+    return summary
+
+
+def print_summary(summary):
+    """Print a per-file table of status and elapsed time"""
+    if not summary:
+        print("No files were processed")
+        return
+
+    width = max(len(result["file"]) for result in summary)
+    header = "\n{:<{w}}  {:<8}  {:>10}"
+    print(header.format("file", "status", "elapsed (s)", w=width))
+    for result in summary:
+        print("{:<{w}}  {:<8}  {:>10.1f}".format(result["file"],
+                                                 result["status"],
+                                                 result["elapsed"],
+                                                 w=width))
+
+    failed = [r for r in summary if r["status"] != "success"]
+    print("\n{} succeeded, {} failed".format(len(summary) - len(failed),
+                                             len(failed)))
@@ -0,0 +1,168 @@
+from scripts.data.constants import PIPE_NAME
+from scripts.pipeline import planner
+
+import fcntl
+import json
+import os
+
+# memory used by a step per MB of raw data, until measured
+DEFAULT_EXPANSION = 6.
+
+# worker memory in MB before it reads a recording, until measured
+DEFAULT_BASE_MB = 300.
+
+# measurements kept per step, the most recent ones
+HISTORY = 20
+
+
+def model_path(root):
+    """Path of the memory model of the derivatives under root"""
+    return os.path.join(root, "derivatives", "pipeline_" + PIPE_NAME,
+                        "memory_model.json")
+
+
+def read_model(path):
+    """Read the memory model learned from earlier runs
+    Parameters
+    ----------
+    path:   str
+            JSON file written by write_model
+
+    Returns
+    ----------
+    model:  dict
+            base: worker memory in MB before reading a recording,
+            steps: per step, the measured MB of memory per MB of raw data.
+            Empty for a missing or unreadable file
+    """
+    try:
+        with open(path) as fp:
+            model = json.load(fp)
+    except (OSError, ValueError):
+        model = {}
+    model.setdefault("base", [])
+    model.setdefault("steps", {})
+    return model
+
+
+def write_model(path, model):
+    """Write the memory model, replacing the file atomically"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as fp:
+        json.dump(model, fp, indent=4)
+    os.replace(tmp_path, path)
+
+
+def record(path, summary, sizes):
+    """Add the memory measured while processing files to the model file
+
+    The model is locked while it is updated, so that the tasks of a sharded
+    or queued run all add their measurements.
+
+    Parameters
+    ----------
+    path:   str
+            model file (model_path)
+    summary:    list
+                status dictionaries returned by runner.preprocess_files
+    sizes:  dict
+            size in MB of the raw data of every file, by file name
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        write_model(path, update_model(read_model(path), summary, sizes))
+
+
+def update_model(model, summary, sizes):
+    """Add the memory measured while processing files to the model
+
+    The expansion of a step is its peak RSS above the memory of the worker
+    before it read the recording, divided by the size of the raw data.
+
+    Parameters
+    ----------
+    model:  dict
+            memory model returned by read_model, updated in place
+    summary:    list
+                status dictionaries returned by runner.preprocess_files
+    sizes:  dict
+            size in MB of the raw data of every file, by file name
+    """
+    for result in summary:
+        size = sizes.get(result["file"])
+        base = result.get("base_rss")
+        if result["status"] != "success" or not size or base is None:
+            continue
+
+        model["base"] = (model["base"] + [base])[-HISTORY:]
+        for step, values in (result.get("metrics") or {}).items():
+            if "peak_rss" not in values:
+                continue
+            expansion = max(values["peak_rss"] - base, 0) / size
+            history = model["steps"].get(step, []) + [expansion]
+            model["steps"][step] = history[-HISTORY:]
+    return model
+
+
+def expansion(model, step):
+    """Largest recently measured expansion of a step, or the default"""
+    return max(model["steps"].get(step) or [DEFAULT_EXPANSION])
+
+
+def estimate_mb(model, size, steps):
+    """Estimated peak memory in MB of a worker processing a recording
+    Parameters
+    ----------
+    model:  dict
+            memory model returned by read_model
+    size:   float
+            size in MB of the raw data of the recording
+    steps:  list
+            names of the measured blocks: the pipeline steps, "load" and
+            "write"
+
+    Returns
+    ----------
+    estimate:   float
+                worker memory plus the size of the data times the largest
+                expansion of any step
+    """
+    base = max(model["base"] or [DEFAULT_BASE_MB])
+    return base + size * max(expansion(model, step) for step in steps)
+
+
+def file_sizes(files):
+    """Size in MB of the raw data of every file, read from the headers"""
+    return {file.basename: planner.data_bytes(file) / 2 ** 20
+            for file in files}
+
+
+def next_file(estimates, pending, running, budget):
+    """Pick the next file to start within the memory budget
+    Parameters
+    ----------
+    estimates:  list
+                estimated peak memory in MB of every file
+    pending:    list
+                indices of the files not started, largest estimate first
+    running:    list
+                indices of the files being processed
+    budget: float
+            memory in MB all running files may use together
+
+    Returns
+    ----------
+    index:  int | None
+            largest pending file that fits in the memory left, a file too
+            large for the budget once nothing else runs, or None to wait for
+            a running file to finish
+    """
+    free = budget - sum(estimates[idx] for idx in running)
+    for idx in pending:
+        if estimates[idx] <= free:
+            return idx
+    if not running and pending:
+        return pending[0]
+    return None
@@ -0,0 +1,105 @@
+from scripts.pipeline.cache import data_files
+
+import heapq
+import os
+
+import mne
+
+
+def parse_shard(value):
+    """Parse a shard given as "i/N" into (i, N), with 0 <= i < N"""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise ValueError("shard must look like i/N, got {!r}".format(value))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError("shard index must be between 0 and N - 1, "
+                         "got {!r}".format(value))
+    return index, count
+
+
+def _n_channels(file):
+    """Number of channels of a recording, read from its channels.tsv sidecar
+    or from the header of the raw file"""
+    channels = file.copy().update(suffix="channels", extension=".tsv")
+    try:
+        with open(channels.fpath) as fp:
+            # one row per channel below the header
+            return max(sum(1 for line in fp if line.strip()) - 1, 1)
+    except OSError:
+        pass
+
+    try:
+        return len(mne.io.read_raw(file.fpath, preload=False,
+                                   verbose=False).ch_names)
+    except Exception:
+        return 1
+
+
+def estimate_cost(file):
+    """Estimated processing cost of a recording: data size times channels
+    Parameters
+    ----------
+    file:   mne_bids.BIDSPath
+            path of the raw recording
+
+    Returns
+    ----------
+    cost:   int
+            size in bytes of the recording and its data companions,
+            multiplied by its number of channels
+    """
+    size = sum(os.path.getsize(path) for path in data_files(file))
+    return size * _n_channels(file)
+
+
+def balance(costs, count):
+    """Split items into count groups of about equal total cost
+
+    Uses the longest-processing-time rule: the most expensive remaining item
+    goes to the group with the lowest total so far. Ties are broken by item
+    position, so every caller with the same costs gets the same split.
+
+    Parameters
+    ----------
+    costs:  list
+            cost of every item
+    count:  int
+            number of groups
+
+    Returns
+    ----------
+    groups: list
+            group of every item, in the order of costs
+    """
+    groups = [0] * len(costs)
+    loads = [(0, group) for group in range(count)]
+    order = sorted(range(len(costs)), key=lambda i: (-costs[i], i))
+    for i in order:
+        load, group = heapq.heappop(loads)
+        groups[i] = group
+        heapq.heappush(loads, (load + costs[i], group))
+    return groups
+
+
+def shard_files(files, index, count, cost=estimate_cost):
+    """Select the files of one shard of a size-balanced split
+    Parameters
+    ----------
+    files:  list
+            BIDS paths as returned by load.load_files, in the same order for
+            every shard
+    index:  int
+            shard to select, 0 <= index < count
+    count:  int
+            number of shards
+    cost:   function
+            estimated cost of a file
+
+    Returns
+    ----------
+    files:  list
+            files of the shard, in their original order
+    """
+    groups = balance([cost(file) for file in files], count)
+    return [file for file, group in zip(files, groups) if group == index]
@@ -0,0 +1,217 @@
+from scripts.data.constants import PIPE_NAME
+
+import json
+import os
+import socket
+import threading
+import time
+
+
+def queue_dir(root, name):
+    """Directory of the work queue name of the derivatives under root"""
+    return os.path.join(root, "derivatives", "pipeline_" + PIPE_NAME,
+                        "queue", name)
+
+
+class WorkQueue:
+    """Queue of files shared by every task of a run through lock files
+
+    Any number of tasks, on any number of nodes, claim files one at a time
+    until every file is done. A task claims a file by creating
+    claims/<file>.claim, which only succeeds for one task, and marks it done
+    by writing done/<file>.json. Only the file system must be shared: file
+    creation and renames are atomic on NFS and cluster file systems, unlike
+    the locks SQLite relies on.
+
+    While the files of a task are processed, a background thread renews its
+    claims every ttl / 4 seconds. The claim of a task that died expires ttl
+    seconds after its last renewal, and another task takes the file over. A
+    file whose claims expired max_attempts times (e.g. one that gets its
+    tasks killed for running out of memory) is marked as failed.
+
+    Parameters
+    ----------
+    path:   str
+            queue directory, shared by all tasks (see queue_dir)
+    ttl:    float
+            seconds after its last renewal a claim expires
+    max_attempts:   int
+                    number of claims of a file before it is given up
+    poll:   float | None
+            seconds between checks for expired claims while files claimed
+            by other tasks are left, ttl / 10 if None
+    """
+
+    def __init__(self, path, ttl=600., max_attempts=3, poll=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.poll = ttl / 10 if poll is None else poll
+        self.owner = "{}:{}".format(socket.gethostname(), os.getpid())
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        for child in ("claims", "done"):
+            os.makedirs(os.path.join(path, child), exist_ok=True)
+        self._thread = threading.Thread(target=self._renew, daemon=True)
+        self._thread.start()
+
+    def _claim_path(self, file):
+        return os.path.join(self.path, "claims", file.basename + ".claim")
+
+    def _done_path(self, file):
+        return os.path.join(self.path, "done", file.basename + ".json")
+
+    def _renew(self):
+        while not self._stop.wait(self.ttl / 4):
+            self._renew_claims()
+
+    def _renew_claims(self):
+        """Renew the claims held, dropping those another task took over"""
+        with self._lock:
+            held = list(self._held)
+        for path in held:
+            owner = self._claim_owner(path)
+            if owner is not None and owner != self.owner:
+                # renewing would keep the claim of the new owner alive
+                with self._lock:
+                    self._held.discard(path)
+                continue
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _claim_owner(path):
+        """Task holding the claim at path, None if it cannot be read"""
+        try:
+            with open(path) as fp:
+                return json.load(fp).get("owner")
+        except (OSError, ValueError):
+            return None
+
+    def _remove_claim(self, path):
+        """Remove the claim at path unless another task has taken it over"""
+        if self._claim_owner(path) == self.owner:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def is_done(self, file):
+        """Whether a task has finished file, successfully or not"""
+        return os.path.exists(self._done_path(file))
+
+    def _create_claim(self, path, attempts):
+        """Create the claim at path, False if another task holds it"""
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as fp:
+            json.dump({"owner": self.owner, "attempts": attempts,
+                       "claimed": time.time()}, fp)
+        return True
+
+    def _take_over(self, path):
+        """Attempts made at an expired claim, None if it is not expired or
+        another task takes it over first"""
+        try:
+            if time.time() - os.path.getmtime(path) < self.ttl:
+                return None
+            # only one task can move the expired claim away
+            expired = "{}.{}.expired".format(path, self.owner)
+            os.rename(path, expired)
+        except OSError:
+            return None
+
+        # another task may have taken the claim over, or its owner renewed
+        # it, between the check and the rename: the moved claim is then put
+        # back, unless yet another task claimed the file meanwhile
+        try:
+            renewed = time.time() - os.stat(expired).st_mtime < self.ttl
+        except OSError:
+            renewed = False
+        if renewed:
+            try:
+                os.link(expired, path)
+            except OSError:
+                pass
+            os.remove(expired)
+            return None
+
+        try:
+            with open(expired) as fp:
+                attempts = json.load(fp).get("attempts", 1)
+        except (OSError, ValueError):
+            attempts = 1
+        os.remove(expired)
+        return attempts
+
+    def claim(self, file):
+        """Claim file for this task
+        Parameters
+        ----------
+        file:   mne_bids.BIDSPath
+                path of the raw recording
+
+        Returns
+        ----------
+        claimed:    bool
+                    True if this task now processes file, False if it is
+                    done or claimed by a task whose claim has not expired
+        """
+        if self.is_done(file):
+            return False
+
+        path = self._claim_path(file)
+        attempts = 0
+        if not self._create_claim(path, attempts + 1):
+            attempts = self._take_over(path)
+            if attempts is None:
+                return False
+            if attempts >= self.max_attempts:
+                print("{}: claim expired {} times, giving up".format(
+                    file.basename, attempts))
+                self.complete(file, "failed")
+                return False
+            if not self._create_claim(path, attempts + 1):
+                return False
+
+        # the file may have been finished since it was checked
+        if self.is_done(file):
+            self._remove_claim(path)
+            return False
+
+        with self._lock:
+            self._held.add(path)
+        return True
+
+    def complete(self, file, status):
+        """Mark file as done and release its claim"""
+        done = self._done_path(file)
+        tmp_path = "{}.{}.tmp".format(done, self.owner)
+        with open(tmp_path, "w") as fp:
+            json.dump({"status": status, "owner": self.owner,
+                       "finished": time.time()}, fp)
+        os.replace(tmp_path, done)
+        self.release(file)
+
+    def release(self, file):
+        """Give up the claim of file, if this task holds it"""
+        path = self._claim_path(file)
+        with self._lock:
+            held = path in self._held
+            self._held.discard(path)
+        if held:
+            self._remove_claim(path)
+
+    def close(self):
+        """Stop renewing claims and release those still held"""
+        self._stop.set()
+        self._thread.join()
+        with self._lock:
+            held, self._held = self._held, set()
+        for path in held:
+            self._remove_claim(path)
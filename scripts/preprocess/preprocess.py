@@ -1,14 +1,46 @@
 import autoreject as ar
 import collections
+import fcntl
+import functools
+import hashlib
+import json
 import mne
 import numpy as np
+import os
 import pandas as pd
+import shutil
+import socket
 import sys
-
+import tempfile
+import time
+import weakref
+
+from concurrent.futures import ThreadPoolExecutor
+from mne.annotations import _annotations_starts_stops, _sync_onset
+# helpers of Raw.filter, filter_data applies its kernels the way MNE 0.23
+# does; recheck them when upgrading MNE
+from mne.filter import (_filt_check_picks, _filt_update_info,
+                        _overlap_add_filter)
+from mne.io.pick import _picks_to_idx
 from mne.preprocessing.bads import _find_outliers
 from scipy.stats import zscore
 
+# 1 Hz high-passed copies of filtered recordings, made for ica_raw, by id of
+# the recording: MNE objects hash their samples, which may not be loaded
+_ICA_INPUTS = {}
+
+
+def _drops_ica_input(step):
+    """Decorate a step that changes the samples of raw in place, dropping
+    the copy filter_data made for ica_raw as it no longer matches them"""
+    @functools.wraps(step)
+    def wrapper(raw, *args, **kwargs):
+        _ICA_INPUTS.pop(id(raw), None)
+        return step(raw, *args, **kwargs)
+    return wrapper
 
+
+@_drops_ica_input
 def reref_raw(raw, ref_channels=None):
     """Re-reference the data to the average of all electrodes
     Parameters
@@ -60,7 +92,64 @@ def reref_raw(raw, ref_channels=None):
     return raw, {"Reference": reref_details}
 
 
-def filter_data(raw, l_freq=0.3, h_freq=40):
+@functools.lru_cache(maxsize=32)
+def _filter_kernel(sfreq, l_freq, h_freq, fir_window="hamming",
+                   fir_design="firwin", ica_l_freq=None):
+    """FIR kernel of raw.filter for a pass band, designed once per process
+
+    With ica_l_freq, the kernel of the band followed by a high-pass at
+    ica_l_freq, i.e. the filtering ica_raw applies to the output of
+    filter_data before training the ICA.
+    """
+    if ica_l_freq is None:
+        h = mne.filter.create_filter(None, sfreq, l_freq, h_freq,
+                                     fir_window=fir_window,
+                                     fir_design=fir_design, verbose=False)
+    else:
+        h = np.convolve(
+            _filter_kernel(sfreq, l_freq, h_freq, fir_window, fir_design),
+            _filter_kernel(sfreq, ica_l_freq, None, fir_window, fir_design))
+    # shared by every caller
+    h.flags.writeable = False
+    return h
+
+
+# channels converted to float64 at a time to filter single-precision data
+_FILTER_BLOCK = 16
+
+
+def _filter_rows(x, h, picks):
+    """Filter rows picks of x in place
+
+    MNE filters float64 only; other data is filtered a block of channels at
+    a time, so it is never converted whole.
+    """
+    if x.dtype == np.float64:
+        _overlap_add_filter(x, h, picks=picks, copy=False)
+        return
+
+    for start in range(0, len(picks), _FILTER_BLOCK):
+        block = picks[start:start + _FILTER_BLOCK]
+        rows = x[block].astype(np.float64)
+        _overlap_add_filter(rows, h, copy=False)
+        x[block] = rows
+
+
+def _apply_kernel(x, h, picks, n_threads):
+    """Filter rows picks of x in place, splitting them between threads"""
+    groups = [group for group in np.array_split(picks, n_threads)
+              if len(group)]
+    if len(groups) == 1:
+        _filter_rows(x, h, picks)
+        return
+
+    # the FFTs release the GIL and every thread writes its own rows
+    with ThreadPoolExecutor(len(groups)) as pool:
+        list(pool.map(lambda group: _filter_rows(x, h, group), groups))
+
+
+@_drops_ica_input
+def filter_data(raw, l_freq=0.3, h_freq=40, n_threads=1, ica_l_freq=None):
     """Final and automatic rejection of bad epochs
     Parameters
     ----------
@@ -73,6 +162,15 @@ def filter_data(raw, l_freq=0.3, h_freq=40):
     h_freq: float
             higher pass-band edge
 
+    n_threads:  int
+                number of threads filtering channels in parallel
+
+    ica_l_freq: float | None
+                also make, in the same pass, the copy high-passed at
+                ica_l_freq that ica_raw trains on, so that ica_raw does not
+                filter the recording again. Uses memory for a second copy
+                of the data until ica_raw runs
+
     Returns
     ----------
     raw_filtered:   mne.io.Raw
@@ -83,7 +181,33 @@ def filter_data(raw, l_freq=0.3, h_freq=40):
     """
     try:
         raw.load_data()
-        raw_filtered = raw.filter(l_freq=l_freq, h_freq=h_freq)
+
+        # same filter as raw.filter, with kernels reused between files
+        sfreq = raw.info["sfreq"]
+        update_info, picks = _filt_check_picks(raw.info, None, l_freq,
+                                               h_freq)
+        h = _filter_kernel(sfreq, l_freq, h_freq)
+        h_ica = None if ica_l_freq is None else \
+            _filter_kernel(sfreq, l_freq, h_freq, ica_l_freq=ica_l_freq)
+
+        # samples outside the filtered spans are kept as they are, like raw
+        ica_data = None if h_ica is None else raw._data.copy()
+        onsets, ends = _annotations_starts_stops(
+            raw, ('edge', 'bad_acq_skip'), invert=True)
+        for start, stop in zip(onsets, ends):
+            if ica_data is not None:
+                _apply_kernel(ica_data[:, start:stop], h_ica, picks,
+                              n_threads)
+            _apply_kernel(raw._data[:, start:stop], h, picks, n_threads)
+        _filt_update_info(raw.info, update_info, l_freq, h_freq)
+        raw_filtered = raw
+
+        if ica_data is not None:
+            _ICA_INPUTS[id(raw_filtered)] = {"l_freq": ica_l_freq,
+                                             "data": ica_data}
+            # freed with the recording if ica_raw never runs
+            weakref.finalize(raw_filtered, _ICA_INPUTS.pop,
+                             id(raw_filtered), None)
 
         h_pass = raw_filtered.info["highpass"]
         l_pass = raw_filtered.info["lowpass"]
@@ -103,7 +227,228 @@ def filter_data(raw, l_freq=0.3, h_freq=40):
     return raw, {"Filter": filter_details}
 
 
-def ica_raw(raw, montage):
+# bump to refit every stored ICA decomposition
+ICA_VERSION = 1
+
+# high-pass edge in Hz of the copy of the recording ICA is trained on
+ICA_L_FREQ = 1.
+
+# parameters of the ICA fit, recorded with every stored decomposition
+ICA_FIT = {"n_components": None,
+           "method": "picard",
+           "max_iter": 500,
+           "fit_params": {"fastica_it": 5},
+           "decim": None,
+           "n_fit_epochs": None,
+           "random_state": None}
+
+
+def _ica_key(raw, fit_params):
+    """Hash of the data, channels and parameters an ICA is fitted with"""
+    digest = hashlib.sha1()
+    digest.update(json.dumps([ICA_VERSION, raw.ch_names, raw.info['sfreq'],
+                              raw.info['bads'], fit_params],
+                             sort_keys=True).encode())
+    # hashed a channel at a time from the loaded samples, never copying them
+    data = raw._data if raw.preload else None
+    for idx in range(len(raw.ch_names)):
+        row = data[idx] if data is not None else raw.get_data(picks=[idx])[0]
+        digest.update(np.ascontiguousarray(row).data)
+    return digest.hexdigest()
+
+
+def _read_ica(ica_dir, key):
+    """Load a stored ICA decomposition and the details of its fit, or
+    (None, None) if there is none for key"""
+    stem = os.path.join(ica_dir, key)
+    if not os.path.exists(stem + "-ica.fif"):
+        return None, None
+    try:
+        ica = mne.preprocessing.read_ica(stem + "-ica.fif", verbose=False)
+        with open(stem + ".json") as fp:
+            fit_details = json.load(fp)["fit"]
+    except Exception:
+        # unreadable (e.g. partially written) solutions are refitted
+        return None, None
+    return ica, fit_details
+
+
+def _write_ica(ica_dir, key, ica, fit_params, fit_details):
+    """Store an ICA decomposition with the parameters it was fitted with"""
+    os.makedirs(ica_dir, exist_ok=True)
+    stem = os.path.join(ica_dir, key)
+
+    # write to a private name and rename, so readers never see partial files
+    tmp_fname = "{}.{}.tmp-ica.fif".format(stem, os.getpid())
+    ica.save(tmp_fname, verbose=False)
+    os.replace(tmp_fname, stem + "-ica.fif")
+
+    with open(stem + ".json", "w") as fp:
+        json.dump({"input hash": key,
+                   "fit parameters": fit_params,
+                   "fit": fit_details,
+                   "mne version": mne.__version__}, fp, indent=4)
+
+
+def _fit_ica(epochs, fit_params):
+    """Fit an ICA on (a random subset of) epochs
+    Parameters
+    ----------
+    epochs: mne.Epochs
+            clean 1-second training epochs
+    fit_params: dict
+                ICA_FIT with the values chosen for this fit. decim keeps
+                every decim-th sample, n_components may be a fraction of
+                explained variance and n_fit_epochs caps the number of
+                randomly selected training epochs
+
+    Returns
+    ----------
+    ica:    mne.preprocessing.ICA
+            fitted decomposition
+    fit_details:    dict
+                    cost and quality of the fit: time, training epochs and
+                    samples, number of components and the fraction of
+                    variance they explain
+    """
+    start = time.perf_counter()
+
+    n_fit_epochs = fit_params["n_fit_epochs"]
+    if n_fit_epochs is not None and n_fit_epochs < len(epochs):
+        rng = np.random.RandomState(fit_params["random_state"])
+        epochs = epochs[np.sort(rng.choice(len(epochs), n_fit_epochs,
+                                           replace=False))]
+
+    ica = mne.preprocessing.ICA(n_components=fit_params["n_components"],
+                                method=fit_params["method"],
+                                max_iter=fit_params["max_iter"],
+                                fit_params=fit_params["fit_params"],
+                                random_state=fit_params["random_state"])
+    ica.fit(epochs, decim=fit_params["decim"])
+
+    # share of the variance kept by the components, the price of fewer ones
+    variance = ica.pca_explained_variance_
+    fit_details = {"fit time": time.perf_counter() - start,
+                   "fit epochs": len(epochs),
+                   "fit samples": ica.n_samples_,
+                   "components": int(ica.n_components_),
+                   "explained variance": float(
+                       variance[:ica.n_components_].sum() / variance.sum())}
+    return ica, fit_details
+
+
+# seconds of raw data high-pass filtered at a time for the ICA training data
+_ICA_CHUNK = 60.
+
+
+def _bad_annotation_spans(raw):
+    """Onsets and ends in seconds, from the first sample, of BAD annotations
+    """
+    annot = raw.annotations
+    bad = np.array([desc.lower().startswith('bad')
+                    for desc in annot.description], bool)
+    onsets = _sync_onset(raw, annot.onset[bad]) if bad.any() \
+        else np.array([])
+    return onsets, onsets + annot.duration[bad]
+
+
+def _pop_ica_input(raw, l_freq):
+    """High-passed copy of raw made by filter_data, if no step changed the
+    samples of raw since (see _drops_ica_input)"""
+    ica_input = _ICA_INPUTS.pop(id(raw), None)
+    if ica_input is None or ica_input["l_freq"] != l_freq:
+        return None
+    return ica_input["data"]
+
+
+def _ica_training_epochs(raw, l_freq=1., duration=1., reject=1000e-6,
+                         filtered=None):
+    """Build the clean, high-passed fixed-length epochs ICA is trained on
+
+    Equivalent to high-pass filtering a copy of raw, cutting it into
+    fixed-length epochs with make_fixed_length_epochs and dropping those
+    overlapping BAD annotations or above the peak-to-peak reject threshold.
+    The data is filtered _ICA_CHUNK seconds at a time, with margins of one
+    filter length, so that only the kept epochs are held in memory instead of
+    a full filtered copy of the recording.
+
+    Parameters
+    ----------
+    raw:    mne.io.Raw
+            preloaded recording, left unmodified
+    l_freq: float
+            high-pass edge in Hz
+    duration:   float
+                epoch length in seconds
+    reject: float
+            peak-to-peak threshold in V on EEG channels not marked as bad
+    filtered:   np.ndarray | None
+                data of raw already high-passed at l_freq, used instead of
+                filtering raw
+
+    Returns
+    ----------
+    epochs: mne.EpochsArray
+            clean training epochs
+    n_original: int
+                number of epochs outside BAD annotations, before rejection
+    """
+    sfreq = raw.info['sfreq']
+    n_times = len(raw.times)
+    n_samp = int(round(duration * sfreq))
+    n_epochs = n_times // n_samp
+    n_original = n_epochs
+
+    h = _filter_kernel(sfreq, l_freq, None)
+    margin = len(h)
+    epochs_per_chunk = max(int(_ICA_CHUNK / duration), 1)
+    chunk = epochs_per_chunk * n_samp
+
+    # raw.filter only filters data channels
+    picks_filter = _picks_to_idx(raw.info, None, 'data_or_ica', exclude=())
+    picks_reject = mne.pick_types(raw.info, eeg=True, exclude='bads')
+    bad_onsets, bad_ends = _bad_annotation_spans(raw)
+
+    data = np.empty((n_epochs, len(raw.ch_names), n_samp))
+    starts = []
+    for first in range(0, n_epochs * n_samp, chunk):
+        last = min(first + chunk, n_epochs * n_samp)
+        if filtered is not None:
+            start, x = first, filtered[:, first:last]
+        else:
+            start, stop = max(first - margin, 0), min(last + margin, n_times)
+
+            # filter the chunk with enough context for exact interior samples
+            x = raw.get_data(start=start, stop=stop).astype(np.float64,
+                                                            copy=False)
+            _overlap_add_filter(x, h, picks=picks_filter, copy=False)
+
+        for ep_start in range(first, last, n_samp):
+            if ((bad_onsets < (ep_start + n_samp - 1) / sfreq)
+                    & (bad_ends > ep_start / sfreq)).any():
+                # like make_fixed_length_epochs, these are never counted
+                n_original -= 1
+                continue
+            epoch = x[:, ep_start - start:ep_start - start + n_samp]
+            ptp = np.ptp(epoch[picks_reject], axis=1)
+            if (ptp > reject).any():
+                continue
+            data[len(starts)] = epoch
+            starts.append(ep_start)
+
+    info = raw.info.copy()
+    info['highpass'] = float(l_freq)
+    events = np.c_[np.array(starts, int) + raw.first_samp,
+                   np.zeros(len(starts), int), np.ones(len(starts), int)]
+    # the unused tail of data is never copied, the epochs hold a view
+    epochs = mne.EpochsArray(data[:len(starts)], info, events, tmin=0,
+                             event_id={'1': 1}, baseline=None,
+                             verbose=False)
+    return epochs, n_original
+
+
+def ica_raw(raw, montage, ica_dir=None, decim=None, n_components=None,
+            n_fit_epochs=None, random_state=None):
     """Automatic artifacts identification - raw data is modified in place
     Parameters:
     ----------:
@@ -112,6 +457,25 @@ def ica_raw(raw, montage):
             and bad channels removal)
     montage:    str
                 montage
+    ica_dir:    str | None
+                directory where fitted ICA decompositions are stored, keyed
+                by a hash of the input data and fit parameters. A stored
+                decomposition of identical input is reused instead of being
+                refitted. None always fits a new one
+    decim:  int | None
+            fit on every decim-th sample of the training epochs. The
+            unmixing is still applied to the full-rate data. The sampling
+            rate divided by decim should stay above twice the low-pass
+            frequency
+    n_components:   int | float | None
+                    number of components, or the fraction of variance (0 to
+                    1) the retained PCA components must explain. None keeps
+                    every component
+    n_fit_epochs:   int | None
+                    fit on at most this many randomly chosen clean epochs.
+                    None fits on all of them
+    random_state:   int | None
+                    seed of the epoch selection and of the ICA
     Returns:
     ----------
     raw:   mne.io.Raw
@@ -146,36 +510,32 @@ def ica_raw(raw, montage):
         ica_details = {"ERROR": montage_error}
         return raw, {"Ica": ica_details}
 
-    # prepica - step1 - filter
-    # High-pass with 1. Hz
-    raw_filtered_1 = raw.copy()
-    raw_filtered_1 = raw_filtered_1.load_data().filter(l_freq=1, h_freq=None)
+    fit_params = dict(ICA_FIT, decim=decim, n_components=n_components,
+                      n_fit_epochs=n_fit_epochs, random_state=random_state)
 
-    # prepica - step2 - segment continuous EEG into arbitrary 1-second epochs
-    epochs_prep = mne.make_fixed_length_epochs(raw_filtered_1,
-                                               duration=1.0,
-                                               preload=True,
-                                               overlap=0.0)
-    # compute the number of original epochs
-    epochs_original = epochs_prep.__len__()
+    # hash the input before anything is derived from it
+    raw.load_data()
+    if ica_dir is not None:
+        key = _ica_key(raw, fit_params)
 
-    # drop epochs that are excessively “noisy”
-    reject_criteria = dict(eeg=1000e-6)       # 1000 µV
-    epochs_prep.drop_bad(reject=reject_criteria)
+    # prepica - High-pass with 1. Hz, segment continuous EEG into arbitrary
+    # 1-second epochs and drop epochs that are excessively “noisy” (1000 µV)
+    epochs_prep, epochs_original = _ica_training_epochs(
+        raw, l_freq=ICA_L_FREQ, duration=1.0, reject=1000e-6,
+        filtered=_pop_ica_input(raw, l_freq=ICA_L_FREQ))
 
     # compute the number of epochs after removal
     epochs_bads_removal = epochs_prep.__len__()
     epochs_bads = epochs_original - epochs_bads_removal
 
-    # ica
-    method = 'picard'
-    max_iter = 500
-    fit_params = dict(fastica_it=5)
-    ica = mne.preprocessing.ICA(n_components=None,
-                                method=method,
-                                max_iter=max_iter,
-                                fit_params=fit_params)
-    ica.fit(epochs_prep)
+    # ica, reusing a decomposition fitted on the same input if available
+    ica, fit_details = _read_ica(ica_dir, key) if ica_dir is not None \
+        else (None, None)
+    ica_reused = ica is not None
+    if not ica_reused:
+        ica, fit_details = _fit_ica(epochs_prep, fit_params)
+        if ica_dir is not None:
+            _write_ica(ica_dir, key, ica, fit_params, fit_details)
 
     # exclude eog
     # Note: should be edited later for "ch_name"
@@ -189,11 +549,121 @@ def ica_raw(raw, montage):
                    "bad epochs": epochs_bads,
                    "bad epochs rate": epochs_bads / epochs_original,
                    "eog indices": eog_indices,
-                   "eog_scores": eog_scores}
+                   "eog_scores": eog_scores,
+                   "ica reused": ica_reused,
+                   "fit": fit_details}
 
     return raw_icaed, {"Ica": ica_details}
 
 
+# number of epochs copied into memory-mapped storage at a time
+_MEMMAP_BLOCK = 100
+
+
+def _memmap_array(shape, tmp_dir, dtype=np.float64):
+    """Allocate an array backed by an unlinked file in tmp_dir
+
+    The file is removed from tmp_dir right away; its disk space is released
+    when the last reference to the array is gone.
+    """
+    if not np.prod(shape):
+        return np.empty(shape, dtype)
+
+    os.makedirs(tmp_dir, exist_ok=True)
+    fd, fname = tempfile.mkstemp(suffix=".dat", dir=tmp_dir)
+    os.close(fd)
+    try:
+        data = np.memmap(fname, dtype=dtype, mode="w+", shape=shape)
+    finally:
+        os.unlink(fname)
+    return data
+
+
+def _memmap_dir(epochs):
+    """Directory of the memory-mapped data of epochs, None if in memory"""
+    data = getattr(epochs, "_data", None)
+    if isinstance(data, np.memmap) and data.filename is not None:
+        return os.path.dirname(data.filename)
+    return None
+
+
+def _memmap_epochs(epochs, tmp_dir):
+    """Load epochs into memory-mapped storage in tmp_dir instead of RAM
+
+    Epochs that are not preloaded are read from their raw data
+    _MEMMAP_BLOCK at a time, so the full array is never held in memory.
+    Preloaded epochs are moved to the memory map. Operates in place.
+
+    MNE has no public way to load epochs into a given array, so the loaded
+    state is set the way BaseEpochs.load_data of MNE 0.23 sets it; recheck
+    it when upgrading MNE. mne.EpochsArray is no alternative, it copies data
+    that is not float64. Only these epochs are memory-mapped: their copies,
+    e.g. epochs.copy() or the snapshots of an asynchronous write, hold the
+    full array in RAM.
+    """
+    if not epochs.preload:
+        epochs.drop_bad()
+
+    # keep the precision of the data the epochs are read from
+    source = epochs if epochs.preload else epochs._raw
+    dtype = getattr(getattr(source, "_data", None), "dtype", np.float64)
+    data = _memmap_array((len(epochs), len(epochs.ch_names),
+                          len(epochs.times)), tmp_dir, dtype)
+    for start in range(0, len(epochs), _MEMMAP_BLOCK):
+        block = slice(start, start + _MEMMAP_BLOCK)
+        data[block] = epochs._data[block] if epochs.preload \
+            else epochs.get_data(item=block)
+
+    # mark the epochs as loaded, as BaseEpochs.load_data does
+    if not epochs.preload:
+        epochs.preload = True
+        epochs._do_baseline = False
+        epochs._decim_slice = slice(None, None, None)
+        epochs._decim = 1
+        epochs._raw_times = epochs.times
+        epochs._raw = None
+    epochs._data = data
+    return epochs
+
+
+def _transform_blocks(autoRej, epochs, tmp_dir):
+    """autoRej.transform(epochs, return_log=True) for memory-mapped epochs
+
+    AutoReject repairs and drops every epoch on its own, so the epochs are
+    cleaned _MEMMAP_BLOCK at a time and the good ones written straight into
+    a memory map in tmp_dir. Only one block is held in memory.
+    """
+    data = _memmap_array(epochs._data.shape, tmp_dir, epochs._data.dtype)
+    labels, bad_epochs, n_good = [], [], 0
+    for start in range(0, len(epochs), _MEMMAP_BLOCK):
+        block = slice(start, start + _MEMMAP_BLOCK)
+        block_epochs = mne.EpochsArray(
+            epochs._data[block], epochs.info, events=epochs.events[block],
+            tmin=epochs.tmin, event_id=epochs.event_id, baseline=None,
+            verbose=False)
+        block_clean, block_log = autoRej.transform(block_epochs,
+                                                   return_log=True)
+        data[n_good:n_good + len(block_clean)] = block_clean._data
+        n_good += len(block_clean)
+        labels.append(block_log.labels)
+        bad_epochs.append(block_log.bad_epochs)
+
+    reject_log = ar.RejectLog(bad_epochs=np.concatenate(bad_epochs),
+                              labels=np.concatenate(labels),
+                              ch_names=block_log.ch_names)
+
+    # copy the epochs without their samples, which are replaced anyway
+    samples, epochs._data = epochs._data, np.empty((len(epochs), 0, 0))
+    try:
+        epochs_clean = epochs.copy()
+    finally:
+        epochs._data = samples
+    epochs_clean.drop(np.nonzero(reject_log.bad_epochs)[0],
+                      reason='AUTOREJECT')
+    epochs_clean._data = data[:n_good]
+    return epochs_clean, reject_log
+
+
 def segment_data(raw, tmin, tmax, baseline, picks, reject_tmin, reject_tmax,
                  decim, verbose, preload):
     """Used to segment continuous data into epochs
@@ -228,8 +698,10 @@ def segment_data(raw, tmin, tmax, baseline, picks, reject_tmin, reject_tmax,
     verbose:    bool | str | int | None
                 default verbose level
 
-    preload:    bool
-                Indicates whether epochs are in memory.
+    preload:    bool | str
+                Indicates whether epochs are in memory. A directory path
+                keeps the epoch data in a memory-mapped file there, which
+                later steps keep working on
 
     Throws:
     -----------
@@ -258,14 +730,17 @@ def segment_data(raw, tmin, tmax, baseline, picks, reject_tmin, reject_tmax,
                         reject_tmax=reject_tmax,
                         decim=decim,
                         verbose=verbose,
-                        preload=preload
+                        preload=preload is True
                         )
 
-    # get count of all epochs to output dictionary
-    ch_names = epochs.info.ch_names
-    ch_epochs = {}
-    for name in ch_names:
-        ch_epochs[name] = epochs.get_data(picks=name).shape[0]
+    if isinstance(preload, str):
+        _memmap_epochs(epochs, preload)
+    elif not epochs.preload:
+        # count the epochs without loading their data
+        epochs.drop_bad()
+
+    # get count of all epochs to output dictionary, the same for every channel
+    ch_epochs = dict.fromkeys(epochs.info.ch_names, len(epochs))
 
     return epochs, {"Segment": {"Generated Epochs": ch_epochs}}
 
@@ -306,12 +781,233 @@ def plot_sensor_locations(epochs, user_params):
     epochs.plot_sensors(kind=kind_selected, ch_type=ch_types)
 
 
-def final_reject_epoch(epochs):
+# version of the shared AutoReject models, bump to invalidate stored ones
+AR_VERSION = 2
+
+
+def _ar_group_dir(ar_dir, epochs, pool_size, pool_epochs, fit_params):
+    """Directory of the shared AutoReject model of epochs with this channel
+    layout, sampling rate and epoch window, pooled and fitted with these
+    parameters"""
+    # n_jobs does not change the model
+    fit_key = {name: value for name, value in fit_params.items()
+               if name != "n_jobs"}
+    key = hashlib.sha1(json.dumps(
+        [AR_VERSION, epochs.ch_names, epochs.info['sfreq'],
+         float(epochs.tmin), float(epochs.tmax), pool_size, pool_epochs,
+         fit_key], sort_keys=True).encode()).hexdigest()
+    return os.path.join(ar_dir, key[:16])
+
+
+def _read_autoreject(group_dir):
+    """Load the shared AutoReject model of a group, None if not fitted yet"""
+    fname = os.path.join(group_dir, "autoreject.hdf5")
+    if not os.path.exists(fname):
+        return None
+    try:
+        return ar.read_auto_reject(fname)
+    except Exception:
+        # unreadable (e.g. partially written) models are refitted
+        return None
+
+
+def _tmp_owner():
+    """Host and process writing a temporary file, unique across the nodes
+    sharing a directory"""
+    return "{}.{}".format(socket.gethostname(), os.getpid())
+
+
+def _write_autoreject(group_dir, autoRej, n_epochs, n_recordings):
+    """Store a shared AutoReject model and the sample it was fitted on"""
+    stem = os.path.join(group_dir, "autoreject")
+    tmp_fname = "{}.{}.tmp.hdf5".format(stem, _tmp_owner())
+    autoRej.save(tmp_fname, overwrite=True)
+    os.replace(tmp_fname, stem + ".hdf5")
+
+    with open(stem + ".json", "w") as fp:
+        json.dump({"pooled epochs": n_epochs,
+                   "pooled recordings": n_recordings,
+                   "consensus": autoRej.consensus_,
+                   "n_interpolate": autoRej.n_interpolate_,
+                   "autoreject version": ar.__version__}, fp, indent=4,
+                  default=float)
+
+
+def _pool_epochs(group_dir, epochs, pool_size, pool_epochs, random_state):
+    """Add a random sample of epochs to the pool of a group
+    Parameters
+    ----------
+    group_dir:  str
+                directory of the group, the pool is kept in its pool folder
+    epochs: mne.Epochs
+            preloaded epochs of one recording
+    pool_size:  int
+                number of recordings to pool before fitting
+    pool_epochs:    int | None
+                    number of randomly chosen epochs each recording adds,
+                    None for all of them
+    random_state:   int | None
+                    seed of the epoch selection
+
+    Returns
+    ----------
+    pooled: mne.EpochsArray | None
+            epochs of the full pool, None while it has fewer than pool_size
+            recordings
+    n_recordings:   int
+                    number of recordings in the pool
+    """
+    pool_dir = os.path.join(group_dir, "pool")
+    os.makedirs(pool_dir, exist_ok=True)
+
+    data = epochs._data
+    if pool_epochs is not None and pool_epochs < len(epochs):
+        rng = np.random.RandomState(random_state)
+        data = data[np.sort(rng.choice(len(epochs), pool_epochs,
+                                       replace=False))]
+
+    # named after the data, so re-runs of a recording do not count twice
+    fname = hashlib.sha1(np.ascontiguousarray(data).data).hexdigest()
+    tmp_fname = os.path.join(pool_dir, "{}.tmp.npy".format(_tmp_owner()))
+    np.save(tmp_fname, data)
+    os.replace(tmp_fname, os.path.join(pool_dir, fname + ".npy"))
+
+    pool_files = sorted(name for name in os.listdir(pool_dir)
+                        if not name.endswith(".tmp.npy"))
+    if len(pool_files) < pool_size:
+        return None, len(pool_files)
+
+    pooled = np.concatenate([np.load(os.path.join(pool_dir, name))
+                             for name in pool_files])
+
+    # bad channels differ between recordings, thresholds are fitted for all
+    info = epochs.info.copy()
+    info['bads'] = []
+    events = np.column_stack([np.arange(len(pooled)),
+                              np.zeros(len(pooled), int),
+                              np.ones(len(pooled), int)])
+    return mne.EpochsArray(pooled, info, events=events, tmin=epochs.tmin,
+                           verbose=False), len(pool_files)
+
+
+def _fit_autoreject(epochs, fit_params):
+    """Fit AutoReject on (a random subset of) epochs
+    Parameters
+    ----------
+    epochs: mne.Epochs
+            preloaded epochs
+    fit_params: dict
+                candidate n_interpolate and consensus values (None for the
+                AutoReject defaults), number of cross-validation folds,
+                parallel jobs, number of randomly selected epochs to fit on
+                and seed
+
+    Returns
+    ----------
+    autoRej:    autoreject.AutoReject
+                fitted model
+    """
+    n_fit_epochs = fit_params["n_fit_epochs"]
+    if n_fit_epochs is not None and n_fit_epochs < len(epochs):
+        rng = np.random.RandomState(fit_params["random_state"])
+        epochs = epochs[np.sort(rng.choice(len(epochs), n_fit_epochs,
+                                           replace=False))]
+
+    n_interpolate = fit_params["n_interpolate"]
+    autoRej = ar.AutoReject(
+        n_interpolate=None if n_interpolate is None
+        else np.array(n_interpolate),
+        consensus=fit_params["consensus"],
+        cv=fit_params["cv"],
+        n_jobs=fit_params["n_jobs"],
+        random_state=fit_params["random_state"])
+    return autoRej.fit(epochs)
+
+
+def _shared_autoreject(epochs, group_dir, pool_size, pool_epochs, refit,
+                       fit_params):
+    """AutoReject model of the task group of epochs and how it was obtained
+
+    Returns (None, "subject fit") while the pool of the group is not full,
+    in which case the model is fitted on epochs alone.
+    """
+    autoRej = _read_autoreject(group_dir)
+    thresholds = "shared"
+
+    if autoRej is None:
+        # the pool is only changed, fitted and removed under the group lock,
+        # so a single worker fits the model and no pool is read half removed
+        os.makedirs(group_dir, exist_ok=True)
+        with open(os.path.join(group_dir, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            # another worker may have fitted the model while this one waited
+            autoRej = _read_autoreject(group_dir)
+            if autoRej is None:
+                pooled, n_recordings = _pool_epochs(
+                    group_dir, epochs, pool_size, pool_epochs,
+                    fit_params["random_state"])
+                if pooled is None:
+                    return None, "subject fit"
+
+                autoRej = _fit_autoreject(pooled, fit_params)
+                _write_autoreject(group_dir, autoRej, len(pooled),
+                                  n_recordings)
+                shutil.rmtree(os.path.join(group_dir, "pool"),
+                              ignore_errors=True)
+                thresholds = "pooled fit"
+
+    if refit:
+        # keep the shared consensus and n_interpolate, refit the thresholds
+        autoRej = _fit_autoreject(epochs, dict(
+            fit_params, n_interpolate=[autoRej.n_interpolate_['eeg']],
+            consensus=[autoRej.consensus_['eeg']]))
+        return autoRej, "refit"
+
+    # leave out the bad channels of this recording
+    autoRej.picks_ = mne.pick_types(epochs.info, meg=False, eeg=True,
+                                    exclude='bads')
+    return autoRej, thresholds
+
+
+def final_reject_epoch(epochs, ar_dir=None, pool_size=10, pool_epochs=None,
+                       refit=False, n_interpolate=None, consensus=None, cv=10,
+                       n_jobs=1, n_fit_epochs=None, random_state=None):
     """Final and automatic rejection of  epochs
     Parameters
     ----------
     epochs: mne.Epochs object
             instance of the mne.Epochs,
+    ar_dir: str | None
+            directory of AutoReject models shared by all recordings of a
+            task, e.g. ".../autoreject/task-{task}". None fits a model on
+            every recording
+    pool_size:  int
+                number of recordings whose epochs are pooled to fit the shared
+                model. Recordings processed before the pool is full are
+                cleaned with a model of their own
+    pool_epochs:    int | None
+                    number of randomly chosen epochs each recording adds to
+                    the pool, None for all of them
+    refit:  bool
+            refit the thresholds on every recording, keeping the consensus
+            and number of interpolated channels of the shared model
+    n_interpolate:  list | None
+                    candidate numbers of channels to interpolate per epoch,
+                    None for [1, 4, 32] (capped by the number of channels)
+    consensus:  list | None
+                candidate fractions of bad channels that mark an epoch bad,
+                None for 11 values from 0 to 1. Fewer candidates in these
+                two grids make the cross-validation faster
+    cv: int
+        number of cross-validation folds
+    n_jobs: int
+            number of parallel jobs estimating the channel thresholds
+    n_fit_epochs:   int | None
+                    estimate the thresholds on at most this many randomly
+                    chosen epochs, all epochs are cleaned
+    random_state:   int | None
+                    seed of the epoch sampling and the fits
 
     Returns
     ----------
@@ -320,17 +1016,30 @@ def final_reject_epoch(epochs):
 
     output_dict_finalRej:   dictionary
                             dictionary with epochs droped per channel and
-                            channels interpolated
+                            channels interpolated. With ar_dir, "model" is the
+                            shared model file, and "provisional" repeats it
+                            when the recording was cleaned before that model
+                            existed
     """
 
     # creates the output dictionary to store the function output
     output_dict_finalRej = collections.defaultdict(dict)
-    output_dict_finalRej['interpolatedChannels'] = []
+
+    fit_params = {"n_interpolate": n_interpolate, "consensus": consensus,
+                  "cv": cv, "n_jobs": n_jobs, "n_fit_epochs": n_fit_epochs,
+                  "random_state": random_state}
 
     # fit and clean epoch data using autoreject
-    autoRej = ar.AutoReject()
     try:
-        autoRej.fit(epochs)
+        autoRej, thresholds, model = None, "subject fit", None
+        if ar_dir is not None:
+            group_dir = _ar_group_dir(ar_dir, epochs, pool_size, pool_epochs,
+                                      fit_params)
+            model = os.path.join(group_dir, "autoreject.hdf5")
+            autoRej, thresholds = _shared_autoreject(
+                epochs, group_dir, pool_size, pool_epochs, refit, fit_params)
+        if autoRej is None:
+            autoRej = _fit_autoreject(epochs, fit_params)
     except ValueError:
         fr_error = "The least populated class in y has only 1 member, which is too\
              few. The minimum number of groups for any class cannot be\
@@ -339,26 +1048,38 @@ def final_reject_epoch(epochs):
         print(fr_error)
 
         ica_details = {"ERROR": fr_error}
-        return epochs, {"Final Reject": ica_details}
-
-    epochs_clean = autoRej.transform(epochs)
-
-    # Create a rejection log
-    reject_log = autoRej.get_reject_log(epochs)
+        # a new object like on success: the runner may still be writing the
+        # epochs received while the next step modifies these in place
+        return epochs.copy(), {"Final Reject": ica_details}
+
+    # clean the epochs, keeping the rejection log computed on the way.
+    # Memory-mapped epochs are cleaned a block at a time, out of RAM
+    tmp_dir = _memmap_dir(epochs)
+    if tmp_dir is None or not len(epochs):
+        epochs_clean, reject_log = autoRej.transform(epochs, return_log=True)
+    else:
+        epochs_clean, reject_log = _transform_blocks(autoRej, epochs,
+                                                     tmp_dir)
 
     # get channel names
     ch_names = epochs.info.ch_names
 
-    # Create dataframe with the labels of which channel was interpolated
-    df = pd.DataFrame(data=reject_log.labels, columns=ch_names)
-    for ch in ch_names:
-        if df[df[ch] == 2][ch].count() > 0:
-            output_dict_finalRej['interpolatedChannels'].append(ch)
+    # channels interpolated (label 2) in at least one epoch
+    interpolated = np.any(reject_log.labels == 2, axis=0)
+    output_dict_finalRej['interpolatedChannels'] = \
+        [ch for ch, interp in zip(ch_names, interpolated) if interp]
 
+    # store amount of epochs dropped for each channel
+    drop_counts = collections.Counter(epochs_clean.drop_log)
     for ch in ch_names:
-        # store amount of epochs dropped for each channel
-        output_dict_finalRej['epochsDropped'][ch] = str(
-            epochs_clean.drop_log.count((ch,)))
+        output_dict_finalRej['epochsDropped'][ch] = str(drop_counts[(ch,)])
+    output_dict_finalRej['thresholds'] = thresholds
+    if model is not None:
+        output_dict_finalRej['model'] = model
+        if thresholds == "subject fit":
+            # cleaned while the pool filled up, the runner cleans the
+            # recording again once the shared model exists
+            output_dict_finalRej['provisional'] = model
 
     return epochs_clean, output_dict_finalRej
 
@@ -487,13 +1208,215 @@ def hurst(data):
     return p2[0]
 
 
-def identify_badchans_raw(raw):
+def _hurst_levels(npoints):
+    """Number of pairwise averaging levels hurst visits for a series length
+    """
+    n_levels = 0
+    while npoints > 4:
+        n_levels += 1
+        npoints = npoints // 2
+    return n_levels
+
+
+def _dyadic_std(data, n_levels):
+    """Standard deviation of every channel at successive pairwise averages
+
+    Parameters:
+    ----------
+    data:    2D numpy array
+             (channels x samples) matrix of timeseries
+    n_levels:   int
+                number of halvings to compute
+
+    Returns
+    -------
+    stds:   2D numpy array
+            (n_levels x channels) standard deviations, level 0 being the
+            original timeseries
+    """
+    stds = np.empty((n_levels, data.shape[0]))
+    for level in range(n_levels):
+        stds[level] = np.std(data, axis=1)
+
+        # average adjacent points in pairs, dropping an odd trailing point
+        npoints = data.shape[1] // 2
+        data = (data[:, 1:2 * npoints:2] + data[:, 0:2 * npoints:2]) * 0.5
+
+    return stds
+
+
+def _hurst_fit(stds):
+    """Hurst exponent of every channel from its dyadic standard deviations
+
+    Parameters:
+    ----------
+    stds:   2D numpy array
+            (levels x channels) output of _dyadic_std
+
+    Returns
+    -------
+    h:    1D numpy array
+          slope of the log-log fit per channel, NaN where it is undefined
+    """
+    n_levels, n_chans = stds.shape
+    h = np.full(n_chans, np.nan)
+
+    binsizes = 2.0 ** np.arange(n_levels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logx = np.log(binsizes)
+        logy = np.log(binsizes[:, np.newaxis] * stds)
+
+    # a line needs two levels, and flat or non-finite channels cannot be
+    # fitted either (hurst returns NaN for both)
+    valid = np.isfinite(logy).all(axis=0)
+    if n_levels < 2 or not valid.any():
+        return h
+
+    # one least-squares solve shared by every channel
+    h[valid] = np.polyfit(logx, logy[:, valid], 1)[0]
+    return h
+
+
+def hurst_batch(data):
+    """Estimate the Hurst exponent of every channel at once.
+
+    Array-based equivalent of calling hurst on each row of data.
+
+    Parameters:
+    ----------
+    data:    2D numpy array
+             (channels x samples) matrix of timeseries
+
+    Returns
+    -------
+    h:    1D numpy array
+          The estimation of the Hurst exponent for each channel.
+    """
+    data = np.atleast_2d(data)
+    n_levels = _hurst_levels(data.shape[1])
+    return _hurst_fit(_dyadic_std(data, n_levels))
+
+
+# streamed chunks are aligned to this many samples so that the first
+# log2(_HURST_BLOCK) pairwise averages of hurst never straddle two chunks
+_HURST_BLOCK = 1024
+
+
+def _merge_moments(count, mean, m2, data):
+    """Merge a chunk into running per-channel count, mean and sum of squared
+    deviations (Chan et al. pairwise update)"""
+    n_new = data.shape[1]
+    if n_new == 0:
+        return count, mean, m2
+
+    mean_new = data.mean(axis=1)
+    m2_new = ((data - mean_new[:, np.newaxis]) ** 2).sum(axis=1)
+
+    total = count + n_new
+    delta = mean_new - mean
+    mean = mean + delta * n_new / total
+    m2 = m2 + m2_new + delta ** 2 * count * n_new / total
+    return total, mean, m2
+
+
+def _badchan_stats(raw):
+    """Variance, correlation matrix and Hurst exponent of every channel,
+    computed on the full data matrix"""
+    raw_data = raw.get_data()
+
+    chns_var = np.var(raw_data, axis=1)
+    chns_corr = np.corrcoef(raw_data)
+    hurst_exp = hurst_batch(raw_data)
+    return chns_var, chns_corr, hurst_exp
+
+
+def _badchan_stats_streaming(raw, chunk_samples):
+    """Variance, correlation matrix and Hurst exponent of every channel,
+    accumulated over fixed-size time chunks
+
+    Only one chunk of data is held at a time, plus the (channels x channels)
+    co-moment matrix and the hurst series once it has been averaged down by
+    _HURST_BLOCK.
+
+    Parameters:
+    ----------
+    raw:    mne.io.Raw
+            raw object of EEG data
+    chunk_samples:  int
+                    number of samples read at a time, rounded up to a
+                    multiple of _HURST_BLOCK
+
+    Returns
+    -------
+    chns_var, chns_corr, hurst_exp: numpy arrays
+                                    same values as _badchan_stats
+    """
+    n_chans, n_times = len(raw.ch_names), raw.n_times
+    chunk_samples = -(-max(chunk_samples, 1) // _HURST_BLOCK) * _HURST_BLOCK
+
+    # running mean and co-moment of the data for variance and correlation
+    count, mean = 0, np.zeros(n_chans)
+    comoment = np.zeros((n_chans, n_chans))
+
+    # running moments of each pairwise-averaged level of hurst
+    n_levels = _hurst_levels(n_times)
+    n_streamed = min(n_levels, int(np.log2(_HURST_BLOCK)))
+    levels = [(0, np.zeros(n_chans), np.zeros(n_chans))
+              for _ in range(n_streamed)]
+    averaged = []
+
+    for start in range(0, n_times, chunk_samples):
+        data = raw.get_data(start=start, stop=min(start + chunk_samples,
+                                                  n_times))
+
+        n_new = data.shape[1]
+        mean_new = data.mean(axis=1)
+        centered = data - mean_new[:, np.newaxis]
+        delta = mean_new - mean
+        total = count + n_new
+        comoment += centered @ centered.T
+        comoment += np.outer(delta, delta) * count * n_new / total
+        mean += delta * n_new / total
+        count = total
+        del centered
+
+        for level in range(n_streamed):
+            levels[level] = _merge_moments(*levels[level], data)
+
+            # average adjacent points in pairs, as in hurst
+            npoints = data.shape[1] // 2
+            data = (data[:, 1:2 * npoints:2] + data[:, 0:2 * npoints:2]) * 0.5
+
+        if n_levels > n_streamed:
+            averaged.append(data)
+
+    chns_var = np.diag(comoment) / count
+    with np.errstate(divide='ignore', invalid='ignore'):
+        std = np.sqrt(np.diag(comoment))
+        chns_corr = np.clip(comoment / np.outer(std, std), -1, 1)
+
+    # finish the coarse levels of hurst on the (short) averaged series
+    stds = [np.sqrt(m2 / level_count) for level_count, _, m2 in levels]
+    if n_levels > n_streamed:
+        averaged = np.concatenate(averaged, axis=1)
+        stds.extend(_dyadic_std(averaged, n_levels - n_streamed))
+    hurst_exp = _hurst_fit(np.array(stds).reshape(n_levels, n_chans))
+
+    return chns_var, chns_corr, hurst_exp
+
+
+def identify_badchans_raw(raw, chunk_duration=None):
     """Automatic bad channel identification - raw data is modified in place
 
     Parameters:
     ----------:
     raw:    mne.io.Raw
             initially loaded raw object of EEG data
+    chunk_duration: float | None
+                    length in seconds of the time chunks the channel
+                    statistics are accumulated over, which bounds the extra
+                    memory used by this step. None computes them on a full
+                    copy of the data
 
     Returns:
     ----------
@@ -504,8 +1427,13 @@ def identify_badchans_raw(raw):
                         dictionary with relevant bad channel information
     """
 
-    # get raw data matrix
-    raw_data = raw.get_data()
+    # get variance, correlation and hurst exponent of each channel
+    if chunk_duration is None:
+        chns_var, chns_corr, hurst_exp = _badchan_stats(raw)
+    else:
+        chunk_samples = int(np.ceil(chunk_duration * raw.info['sfreq']))
+        chns_var, chns_corr, hurst_exp = _badchan_stats_streaming(
+            raw, chunk_samples)
 
     # get spherical and polar coordinates
     chs_x = np.array([loc['loc'][1] for loc in raw.info['chs']])
@@ -530,7 +1458,6 @@ def identify_badchans_raw(raw):
     chanlocs['distance'] = chanlocs.apply(lambda x: np.sqrt(x['radius']**2 + ref_radius**2 - 2 * x['radius'] * ref_radius * np.cos(x['theta'] / 180 * np.pi - ref_theta / 180 * np.pi)), axis=1)
 
     # find bad channels based on their variances and correct for the distance
-    chns_var = np.var(raw_data, axis=1)
     reg_var = np.polyfit(chanlocs['distance'], chns_var, 2)
     fitcurve_var = np.polyval(reg_var, chanlocs['distance'])
     corrected_var = chns_var - fitcurve_var
@@ -540,7 +1467,7 @@ def identify_badchans_raw(raw):
                                                         tail=0)]
 
     # find bad channels based on correlations and correct for the distance
-    chns_cor = np.nanmean(abs(np.corrcoef(raw_data)), axis=0)
+    chns_cor = np.nanmean(abs(chns_corr), axis=0)
     chns_cor[128] = np.nanmean(chns_cor)
     reg_cor = np.polyfit(chanlocs['distance'], chns_cor, 2)
     fitcurve_cor = np.polyval(reg_cor, chanlocs['distance'])
@@ -551,7 +1478,6 @@ def identify_badchans_raw(raw):
                                                         tail=0)]
 
     # find bad channels based on hurst exponent
-    hurst_exp = np.array([hurst(i) for i in raw_data])
     hurst_exp[np.isnan(hurst_exp)] = np.nanmean(hurst_exp)
     bads_loc = np.where(abs(zscore(hurst_exp)) > 3)[0]
     bads_hurst = [raw.ch_names[i] for i in bads_loc]
@@ -0,0 +1,28 @@
+from scripts.data.write import BackgroundWriter
+
+import pytest
+
+
+def test_jobs_run_in_order():
+    done = []
+    writer = BackgroundWriter(queue_size=1)
+    for i in range(5):
+        writer.submit(done.append, i)
+    writer.close()
+
+    assert done == list(range(5))
+
+
+def test_error_is_raised():
+    def fail():
+        raise OSError("disk full")
+
+    done = []
+    writer = BackgroundWriter(queue_size=2)
+    writer.submit(fail)
+    writer.submit(done.append, 1)
+    with pytest.raises(OSError):
+        writer.close()
+
+    # jobs queued after a failure are skipped
+    assert done == []
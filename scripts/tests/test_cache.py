@@ -0,0 +1,66 @@
+from scripts.pipeline import cache
+
+import pytest
+
+import os
+
+import mne
+import numpy as np
+
+
+@pytest.fixture
+def raw():
+    info = mne.create_info(["Cz", "Pz"], 100., "eeg")
+    return mne.io.RawArray(np.random.RandomState(0).randn(2, 1000), info)
+
+
+@pytest.fixture
+def params():
+    return {"filter_data": {"l_freq": 0.3, "h_freq": 40},
+            "identify_badchans_raw": {}}
+
+
+def test_keys_follow_params(params):
+    keys = cache.cache_keys("input", params)
+
+    # assert changing a downstream step leaves upstream keys untouched
+    params["identify_badchans_raw"]["chunk_duration"] = 10
+    changed = cache.cache_keys("input", params)
+    assert keys[0] == changed[0]
+    assert keys[1] != changed[1]
+
+    # assert keys depend on the input data
+    assert cache.cache_keys("other", params)[0] != keys[0]
+
+
+def test_put_get(tmp_path, raw):
+    outputs = [{"Filter": {"Sampling Rate": 100.}}]
+    cache.put(str(tmp_path), "ab" * 32, raw, outputs)
+
+    eeg_obj, cached_outputs = cache.get(str(tmp_path), "ab" * 32)
+
+    # assert the stored result is returned unchanged
+    np.testing.assert_allclose(eeg_obj.get_data(), raw.get_data(),
+                               rtol=1e-6)
+    assert cached_outputs == outputs
+
+    # assert a missing entry is a cache miss
+    assert cache.get(str(tmp_path), "cd" * 32) is None
+
+
+def test_evict_least_recently_used(tmp_path, raw):
+    for i, key in enumerate(["aa" * 32, "bb" * 32, "cc" * 32]):
+        cache.put(str(tmp_path), key, raw, [])
+        entry = os.path.join(str(tmp_path), key[:2], key)
+        os.utime(entry, (i, i))
+
+    # reading the oldest entry makes it the most recently used
+    cache.get(str(tmp_path), "aa" * 32)
+
+    # assert only the most recently used entry survives a tight limit
+    entry_size = os.path.getsize(os.path.join(str(tmp_path), "aa", "aa" * 32,
+                                              "data_eeg.fif"))
+    cache.evict(str(tmp_path), max_size=1.5 * entry_size / 1e9)
+    assert cache.get(str(tmp_path), "aa" * 32) is not None
+    assert cache.get(str(tmp_path), "bb" * 32) is None
+    assert cache.get(str(tmp_path), "cc" * 32) is None
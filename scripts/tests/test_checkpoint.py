@@ -0,0 +1,81 @@
+from scripts.pipeline import checkpoint
+
+import pytest
+
+import mne
+import numpy as np
+from types import SimpleNamespace
+
+
+@pytest.fixture
+def steps(tmp_path):
+    # two completed steps, each with a small raw intermediate on disk
+    info = mne.create_info(["Cz", "Pz"], 100., "eeg")
+    steps = []
+    for func in ["filter_data", "identify_badchans_raw"]:
+        path = str(tmp_path / "sub-01_proc-{}_eeg.fif".format(func))
+        mne.io.RawArray(np.zeros((2, 100)), info).save(path)
+        steps.append({"func": func, "hash": func + "-hash", "path": path,
+                      "output": {func: {}}})
+    return steps
+
+
+def test_restore_last_step(steps):
+    funcs = ["filter_data", "identify_badchans_raw", "ica_raw"]
+    hashes = ["filter_data-hash", "identify_badchans_raw-hash", "ica-hash"]
+
+    n_done, eeg_obj, kept = checkpoint.restore(steps, funcs, hashes)
+
+    # assert both completed steps are reused
+    assert n_done == 2
+    assert isinstance(eeg_obj, mne.io.BaseRaw)
+    assert kept == steps
+
+
+def test_restore_changed_params(steps):
+    funcs = ["filter_data", "identify_badchans_raw", "ica_raw"]
+    hashes = ["filter_data-hash", "changed-hash", "ica-hash"]
+
+    n_done, _, kept = checkpoint.restore(steps, funcs, hashes)
+
+    # assert only the steps upstream of the change are reused
+    assert n_done == 1
+    assert kept == steps[:1]
+
+
+def test_restore_missing_file(steps):
+    funcs = ["filter_data", "identify_badchans_raw"]
+    hashes = ["filter_data-hash", "identify_badchans_raw-hash"]
+    steps[1]["path"] += ".missing"
+
+    n_done, _, _ = checkpoint.restore(steps, funcs, hashes)
+
+    # assert the last readable intermediate is used
+    assert n_done == 1
+
+
+def test_chain_precision(tmp_path):
+    path = tmp_path / "sub-01_eeg.fif"
+    path.write_bytes(b"data")
+    file = SimpleNamespace(fpath=path)
+    params = {"filter_data": {}, "ica_raw": {}}
+
+    # a run in another precision restores none of the steps
+    hashes = {precision: checkpoint.chain_hashes(file, params, precision)
+              for precision in [None, "single", "double"]}
+    assert len(set(step for chain in hashes.values()
+                   for step in chain)) == 6
+
+
+def test_chain_data_file(tmp_path):
+    header = tmp_path / "sub-01_eeg.vhdr"
+    header.write_bytes(b"header")
+    samples = tmp_path / "sub-01_eeg.eeg"
+    samples.write_bytes(b"data")
+    file = SimpleNamespace(fpath=header)
+    params = {"filter_data": {}}
+
+    # replacing the samples invalidates the checkpoint, not only the header
+    hashes = checkpoint.chain_hashes(file, params)
+    samples.write_bytes(b"other data")
+    assert checkpoint.chain_hashes(file, params) != hashes
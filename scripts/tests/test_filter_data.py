@@ -1,11 +1,14 @@
 from scripts.preprocess import preprocess as pre
 from scripts.data import load, write
+from scripts.pipeline import runner
 
 import pytest
 
 from pathlib import Path
 
+import mne
 import mne_bids
+import numpy as np
 
 
 @pytest.fixture
@@ -66,3 +69,60 @@ def test_except_value(error_obj):
         assert True
 
         assert isinstance(output_dict, dict)
+
+
+def test_kernel_cache_and_ica_copy():
+    rng = np.random.RandomState(0)
+    info = mne.create_info(6, 250., "eeg")
+    raw = mne.io.RawArray(rng.randn(6, 250 * 120) * 1e-5, info,
+                          verbose=False)
+
+    # same result as raw.filter, with or without threads
+    expected = raw.copy().filter(l_freq=0.3, h_freq=40)
+    filtered, _ = pre.filter_data(raw.copy(), 0.3, 40)
+    np.testing.assert_array_equal(filtered.get_data(), expected.get_data())
+    assert filtered.info["highpass"] == expected.info["highpass"]
+
+    filtered, _ = pre.filter_data(raw.copy(), 0.3, 40, n_threads=3,
+                                  ica_l_freq=1.)
+    np.testing.assert_array_equal(filtered.get_data(), expected.get_data())
+
+    # the ICA copy equals a 1 Hz high-pass of the filtered data
+    epochs, _ = pre._ica_training_epochs(expected)
+    ica_input = pre._pop_ica_input(filtered, 1.)
+    ica_epochs, _ = pre._ica_training_epochs(filtered, filtered=ica_input)
+    np.testing.assert_allclose(ica_epochs.get_data(), epochs.get_data(),
+                               atol=1e-15)
+
+    # used once
+    assert pre._pop_ica_input(filtered, 1.) is None
+
+    # skipped spans are copied unfiltered, like they are left in raw
+    skipped = raw.copy().set_annotations(
+        mne.Annotations([10.], [5.], ["bad_acq_skip"]))
+    filtered, _ = pre.filter_data(skipped.copy(), 0.3, 40, ica_l_freq=1.)
+    ica_input = pre._pop_ica_input(filtered, 1.)
+    np.testing.assert_array_equal(ica_input[:, 2500:3750],
+                                  raw.get_data()[:, 2500:3750])
+    np.testing.assert_array_equal(filtered.get_data()[:, 2500:3750],
+                                  raw.get_data()[:, 2500:3750])
+
+    # and dropped by steps changing the samples in place
+    filtered, _ = pre.filter_data(raw.copy(), 0.3, 40, ica_l_freq=1.)
+    pre.reref_raw(filtered)
+    assert pre._pop_ica_input(filtered, 1.) is None
+
+
+def test_single_precision():
+    rng = np.random.RandomState(0)
+    info = mne.create_info(20, 250., "eeg")
+    raw = mne.io.RawArray(rng.randn(20, 250 * 60) * 1e-5, info,
+                          verbose=False)
+    expected, _ = pre.filter_data(raw.copy(), 0.3, 40)
+
+    # float32 data is filtered in place and stays float32
+    raw_single = runner.set_precision(raw.copy(), "single")
+    filtered, _ = pre.filter_data(raw_single, 0.3, 40, n_threads=2)
+    assert filtered._data.dtype == np.float32
+    np.testing.assert_allclose(filtered.get_data(), expected.get_data(),
+                               rtol=0, atol=1e-6 * np.abs(expected._data).max())
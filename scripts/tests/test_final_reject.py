@@ -3,9 +3,14 @@ from scripts.data import load, write
 
 import pytest
 
+import fcntl
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import mne
 import mne_bids
+import numpy as np
 from mne import Epochs
 
 
@@ -88,3 +93,105 @@ def test_except_value(default_param, select_subjects, error_tasks):
 
             assert True
             assert isinstance(output_dict, dict)
+
+
+def _make_epochs(seed):
+    # 1-second epochs of noise on 16 channels of a standard montage
+    montage = mne.channels.make_standard_montage("standard_1020")
+    info = mne.create_info(montage.ch_names[:16], 100., "eeg")
+    data = np.random.RandomState(seed).randn(16, 100 * 40) * 1e-5
+    raw = mne.io.RawArray(data, info, verbose=False)
+    raw.set_montage(montage)
+    events = np.column_stack([np.arange(100, 3900, 100), np.zeros(38, int),
+                              np.ones(38, int)])
+    return mne.Epochs(raw, events, tmin=0, tmax=0.99, baseline=None,
+                      preload=True, verbose=False)
+
+
+def test_shared_model(tmp_path):
+    ar_dir = str(tmp_path)
+    params = dict(ar_dir=ar_dir, pool_size=2, pool_epochs=20,
+                  random_state=0)
+
+    # pooled from the first two recordings, then applied to the third
+    thresholds, provisional = [], []
+    for seed in range(3):
+        epochs, output_dict = pre.final_reject_epoch(_make_epochs(seed),
+                                                     **params)
+        assert isinstance(epochs, Epochs)
+        thresholds.append(output_dict["thresholds"])
+        provisional.append(output_dict.get("provisional"))
+    assert thresholds == ["subject fit", "pooled fit", "shared"]
+
+    # the first recording waits for the model the others were cleaned with
+    group_dir, = tmp_path.iterdir()
+    assert provisional == [output_dict["model"], None, None]
+    assert output_dict["model"] == str(group_dir / "autoreject.hdf5")
+    assert sorted(path.name for path in group_dir.iterdir()) == \
+        [".lock", "autoreject.hdf5", "autoreject.json"]
+
+    # a worker waiting for the group lock uses the model fitted meanwhile
+    model = group_dir / "autoreject.hdf5"
+    model.rename(tmp_path / "autoreject.hdf5")
+    with open(group_dir / ".lock", "w") as lock, \
+            ThreadPoolExecutor(1) as executor:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        future = executor.submit(pre.final_reject_epoch, _make_epochs(4),
+                                 **params)
+        time.sleep(0.5)
+        assert not future.done()
+        (tmp_path / "autoreject.hdf5").rename(model)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        _, output_dict = future.result()
+    assert output_dict["thresholds"] == "shared"
+
+    # thresholds refitted with the shared grid point
+    _, output_dict = pre.final_reject_epoch(_make_epochs(3), refit=True,
+                                            **params)
+    assert output_dict["thresholds"] == "refit"
+
+    # other fit parameters pool a model of their own
+    _, output_dict = pre.final_reject_epoch(
+        _make_epochs(3), **dict(params, pool_epochs=10))
+    assert output_dict["thresholds"] == "subject fit"
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_fast_fit():
+    epochs = _make_epochs(0)
+
+    # reduced grid, fewer folds and thresholds estimated on 20 epochs
+    rej_epo, output_dict = pre.final_reject_epoch(
+        epochs, n_interpolate=[1, 4], consensus=[0.5], cv=5, n_fit_epochs=20,
+        random_state=0)
+
+    assert isinstance(rej_epo, Epochs)
+    assert output_dict["thresholds"] == "subject fit"
+    assert set(output_dict["epochsDropped"]) == set(epochs.ch_names)
+    assert set(output_dict["interpolatedChannels"]) <= set(epochs.ch_names)
+
+
+def test_fit_error_copy():
+    # too few epochs for the cross-validation
+    epochs = _make_epochs(0)[:3]
+    rej_epo, output_dict = pre.final_reject_epoch(epochs)
+
+    assert "ERROR" in output_dict["Final Reject"]
+    # the next step may change the result in place while the input is saved
+    assert rej_epo is not epochs
+    np.testing.assert_array_equal(rej_epo.get_data(), epochs.get_data())
+
+
+def test_memmap_blocks(tmp_path, monkeypatch):
+    params = dict(n_interpolate=[1, 4], consensus=[0.5], cv=5,
+                  random_state=0)
+    expected, output_dict = pre.final_reject_epoch(_make_epochs(0), **params)
+
+    # memory-mapped epochs are cleaned a block at a time into a memory map
+    monkeypatch.setattr(pre, "_MEMMAP_BLOCK", 10)
+    epochs = pre._memmap_epochs(_make_epochs(0), str(tmp_path))
+    rej_epo, mm_output = pre.final_reject_epoch(epochs, **params)
+    assert pre._memmap_dir(rej_epo) == str(tmp_path)
+    np.testing.assert_array_equal(rej_epo.get_data(), expected.get_data())
+    assert rej_epo.drop_log == expected.drop_log
+    assert mm_output == output_dict
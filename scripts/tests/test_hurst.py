@@ -0,0 +1,29 @@
+from scripts.preprocess import preprocess as pre
+
+import pytest
+import numpy as np
+
+
+@pytest.fixture
+def data():
+    # random walks of uneven length, including a flat (reference) channel
+    rng = np.random.RandomState(0)
+    data = np.cumsum(rng.randn(8, 5001), axis=1) * 1e-6
+    data[-1] = 0
+    return data
+
+
+def test_batch_matches_loop(data):
+    h_loop = np.array([pre.hurst(ch) for ch in data])
+    h_batch = pre.hurst_batch(data)
+
+    # assert both implementations agree, including NaN for the flat channel
+    np.testing.assert_allclose(h_batch, h_loop, rtol=1e-10)
+    assert np.isnan(h_batch[-1])
+
+
+def test_batch_short_series():
+    # series too short for a log-log fit are undefined, as in hurst
+    h_batch = pre.hurst_batch(np.ones((3, 4)))
+
+    assert np.isnan(h_batch).all()
@@ -2,7 +2,9 @@ from scripts.preprocess import preprocess as pre
 from scripts.data import load, write
 
 import pytest
+import mne
 import mne_bids
+import numpy as np
 
 from pathlib import Path
 
@@ -69,3 +71,68 @@ def test_except_value(error_obj):
         assert True
 
         assert isinstance(output_dict, dict)
+
+
+def test_stored_ica(tmp_path):
+    rng = np.random.RandomState(0)
+    info = mne.create_info(8, 100., "eeg")
+    raw = mne.io.RawArray(rng.randn(8, 2000) * 1e-5, info)
+
+    fit_params = dict(pre.ICA_FIT, max_iter=50)
+    key = pre._ica_key(raw, fit_params)
+    assert pre._read_ica(str(tmp_path), key) == (None, None)
+
+    epochs = mne.make_fixed_length_epochs(raw, duration=1.0, preload=True)
+    ica, fit_details = pre._fit_ica(epochs, fit_params)
+    pre._write_ica(str(tmp_path), key, ica, fit_params, fit_details)
+
+    # the stored decomposition is found again for identical input
+    stored, stored_details = pre._read_ica(str(tmp_path),
+                                           pre._ica_key(raw, fit_params))
+    np.testing.assert_allclose(stored.unmixing_matrix_, ica.unmixing_matrix_)
+    assert stored_details == fit_details
+
+    # and not once the data or the bad channels change
+    raw.info["bads"] = ["1"]
+    assert pre._ica_key(raw, fit_params) != key
+
+
+def test_fast_fit():
+    rng = np.random.RandomState(0)
+    info = mne.create_info(8, 100., "eeg")
+    sources = rng.laplace(size=(8, 6000))
+    raw = mne.io.RawArray(rng.randn(8, 8).dot(sources) * 1e-5, info)
+    epochs = mne.make_fixed_length_epochs(raw, duration=1.0, preload=True)
+
+    fit_params = dict(pre.ICA_FIT, max_iter=50, decim=2, n_components=0.9,
+                      n_fit_epochs=20, random_state=0)
+    ica, fit_details = pre._fit_ica(epochs, fit_params)
+
+    assert fit_details["fit epochs"] == 20
+    assert fit_details["fit samples"] == 20 * 50
+    assert fit_details["components"] < 8
+    assert 0.9 <= fit_details["explained variance"] <= 1
+
+
+def test_training_epochs():
+    rng = np.random.RandomState(0)
+    info = mne.create_info(4, 100., "eeg")
+    raw = mne.io.RawArray(rng.randn(4, 20000) * 1e-5, info)
+    raw.info["bads"] = ["3"]
+    raw._data[0, 5000:5010] += 2e-3
+    raw._data[3, 9000:9010] += 2e-3
+    raw.set_annotations(mne.Annotations([120.5], [2.], ["BAD_seg"]))
+
+    # reference: filter a full copy, then epoch it
+    filtered = raw.copy().filter(l_freq=1, h_freq=None)
+    expected = mne.make_fixed_length_epochs(filtered, duration=1.0,
+                                            preload=True)
+    n_expected = len(expected)
+    expected.drop_bad(reject=dict(eeg=1000e-6))
+
+    epochs, n_original = pre._ica_training_epochs(raw)
+
+    assert n_original == n_expected
+    np.testing.assert_array_equal(epochs.events, expected.events)
+    np.testing.assert_allclose(epochs.get_data(), expected.get_data(),
+                               atol=1e-15)
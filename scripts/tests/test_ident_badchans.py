@@ -52,6 +52,27 @@ def test_return_values(default_param, select_subjects, select_tasks):
         assert None not in output_dict.values()
 
 
+def test_streaming_values(default_param, select_subjects, select_tasks):
+
+    default_param["load_data"]["subjects"] = select_subjects
+    default_param["load_data"]["tasks"] = select_tasks
+
+    # Load data using the selected subjects & tasks
+    data = load.load_files(default_param["load_data"])
+
+    for file in data:
+        eeg_obj = mne_bids.read_raw_bids(file)
+        eeg_obj.load_data()
+
+        # identify bad channels on the full data and in 10 second chunks
+        _, output_dict = pre.identify_badchans_raw(eeg_obj.copy())
+        _, stream_dict = pre.identify_badchans_raw(eeg_obj.copy(),
+                                                   chunk_duration=10)
+
+        # assert that streaming finds the same bad channels
+        assert stream_dict == output_dict
+
+
 def test_except_value(error_obj):
     eeg_obj = error_obj
 
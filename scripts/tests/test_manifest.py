@@ -0,0 +1,80 @@
+from scripts.pipeline import manifest
+
+import os
+from types import SimpleNamespace
+
+
+def _recording(tmp_path, name, content):
+    path = tmp_path / name
+    path.write_bytes(content)
+    return SimpleNamespace(basename=name, fpath=path)
+
+
+def _result(file, status="success"):
+    # the state of the input is taken before the file is processed
+    return {"file": file.basename, "status": status,
+            "input": manifest.file_state(file)}
+
+
+def test_incremental_selection(tmp_path, monkeypatch):
+    files = [_recording(tmp_path, "sub-{}_eeg.fif".format(idx), b"data")
+             for idx in range(3)]
+    path = manifest.manifest_path(str(tmp_path))
+    digest = manifest.params_hash({"filter_data": {"l_freq": 0.3}})
+
+    # the failed file and the one waiting for a shared model are processed
+    # again
+    manifest.record(path, [_result(files[0]), _result(files[1], "failed"),
+                           dict(_result(files[2]), provisional="model")],
+                    digest)
+    selected, reasons, _ = manifest.changed_files(
+        files, manifest.read_manifest(path), digest)
+    assert selected == files[1:]
+    assert reasons["new"] == 2
+
+    # a touched file with the same content is skipped, new content is not
+    manifest.record(path, [_result(file) for file in files], digest)
+    os.utime(files[0].fpath, (0, 0))
+    files[1].fpath.write_bytes(b"more data")
+    selected, reasons, touched = manifest.changed_files(
+        files, manifest.read_manifest(path), digest)
+    assert selected == [files[1]]
+    assert reasons == {"changed": 1, "unchanged": 2}
+
+    # the new mtime of the touched file is recorded, so it is not hashed again
+    manifest.write_entries(path, touched)
+    entries = manifest.read_manifest(path)
+    assert entries[files[0].basename]["mtime"] == 0
+    with monkeypatch.context() as patch:
+        patch.setattr(manifest, "file_hash", None)
+        state = manifest.file_state(files[0], entries[files[0].basename])
+        selected, _, _ = manifest.changed_files(files[:1], entries, digest)
+    assert state["hash"] == entries[files[0].basename]["hash"]
+    assert selected == []
+
+    # every file is processed again with other parameters
+    other = manifest.params_hash({"filter_data": {"l_freq": 1.}})
+    selected, _, _ = manifest.changed_files(files, entries, other)
+    assert selected == files
+
+
+def test_deferred_hash(tmp_path, monkeypatch):
+    files = [_recording(tmp_path, "sub-{}_eeg.fif".format(idx), b"data")
+             for idx in range(2)]
+    path = manifest.manifest_path(str(tmp_path))
+    digest = manifest.params_hash({"filter_data": {"l_freq": 0.3}})
+
+    # a plain run records the size and mtime without reading the content
+    monkeypatch.setattr(manifest, "file_hash", None)
+    states = [manifest.file_state(file, hash_content=False) for file in files]
+    assert [state["hash"] for state in states] == [None, None]
+    manifest.record(path, [{"file": file.basename, "status": "success",
+                            "input": state}
+                           for file, state in zip(files, states)], digest)
+
+    # the touched file cannot be compared and is processed again
+    os.utime(files[0].fpath, (0, 0))
+    selected, reasons, _ = manifest.changed_files(
+        files, manifest.read_manifest(path), digest)
+    assert selected == files[:1]
+    assert reasons == {"changed": 1, "unchanged": 1}
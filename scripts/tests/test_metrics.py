@@ -0,0 +1,32 @@
+from scripts.pipeline import metrics
+
+import csv
+import os
+
+
+def test_measure_accumulates():
+    step_metrics = {}
+    for _ in range(2):
+        with metrics.measure(step_metrics, "load"):
+            sum(range(10000))
+    metrics.add_write_time(step_metrics, "load", 0.5)
+
+    entry = step_metrics["load"]
+    assert entry["wall_time"] > 0 and entry["cpu_time"] >= 0
+    assert entry["peak_rss"] > 0
+    assert entry["write_time"] == 0.5
+
+
+def test_write_metrics_csv(tmp_path):
+    summary = [{"file": "a.vhdr", "metrics": {"load": {"wall_time": 1.0},
+                                              "filter_data": {"cpu_time": 2.0}}},
+               {"file": "b.vhdr", "metrics": None}]
+    csv_path = metrics.write_metrics_csv(summary, str(tmp_path))
+    # later runs append below the same header
+    metrics.write_metrics_csv(summary, str(tmp_path))
+
+    with open(csv_path) as fp:
+        rows = list(csv.DictReader(fp))
+    assert os.path.basename(csv_path) == "metrics.csv"
+    assert [row["step"] for row in rows] == ["load", "filter_data"] * 2
+    assert rows[1]["cpu_time"] == "2.0"
@@ -0,0 +1,67 @@
+from scripts.data import write
+from scripts.pipeline import planner
+
+
+def test_template_plan():
+    preprocess_params = write.write_template_params("")["preprocess"]
+    write_params = {"root": "", "cache": None, "intermediates": ["ica_raw"],
+                    "write_queue": 1}
+    plan = planner.make_plan(preprocess_params, write_params)
+    steps = {step["func"]: step for step in plan}
+
+    assert [step["func"] for step in plan] == list(preprocess_params)
+
+    # the ICA copy is only made when asked for
+    assert steps["filter_data"]["params"]["ica_l_freq"] is None
+    assert steps["ica_raw"]["saves"]["filter passes"] == 0
+    steps = {step["func"]: step for step in planner.make_plan(
+        preprocess_params, write_params, ica_copy=True)}
+    assert steps["filter_data"]["params"]["ica_l_freq"] == 1.
+    assert steps["ica_raw"]["saves"]["filter passes"] == 1
+
+    # lazy epochs would be read twice by final_reject_epoch
+    assert steps["segment_data"]["params"]["preload"] is True
+
+    # only the saved output followed by an in-place step is copied
+    assert [step["func"] for step in plan if step["snapshot"]] == []
+    savings = planner.estimate_savings(plan, [])
+    assert savings["copies"] == len(plan) - 1
+    assert "copied bytes" not in planner.estimate_savings(plan)
+
+    # the user parameters are left unchanged
+    assert preprocess_params["segment_data"]["preload"] is None
+    assert preprocess_params["filter_data"]["ica_l_freq"] is None
+
+
+def test_snapshots():
+    preprocess_params = {"filter_data": {}, "identify_badchans_raw": {},
+                         "segment_data": {"preload": "/tmp"},
+                         "interpolate_data": {}}
+    write_params = {"intermediates": ["*"], "write_queue": 1}
+    plan = planner.make_plan(preprocess_params, write_params)
+
+    # segment_data makes new epochs, interpolate_data changes them in place
+    assert [step["snapshot"] for step in plan] == [True, False, True, False]
+    assert plan[2]["params"]["preload"] == "/tmp"
+
+    # without background writes nothing is copied
+    write_params["write_queue"] = 0
+    plan = planner.make_plan(preprocess_params, write_params)
+    assert not any(step["snapshot"] for step in plan)
+
+
+def test_lazy_plan():
+    preprocess_params = write.write_template_params("")["preprocess"]
+    write_params = {"intermediates": [], "write_queue": 0}
+    plan = planner.make_plan(preprocess_params, write_params, lazy=True,
+                             ica_copy=True)
+
+    # memory-mapped data is loaded before ICA only, and not copied for it
+    assert [step["func"] for step in plan if step["materialize"]] == \
+        ["ica_raw"]
+    assert plan[0]["params"]["ica_l_freq"] is None
+
+    # no random access before epoching, the recording stays mapped
+    del preprocess_params["ica_raw"]
+    plan = planner.make_plan(preprocess_params, write_params, lazy=True)
+    assert not any(step["materialize"] for step in plan)
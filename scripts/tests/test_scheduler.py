@@ -0,0 +1,35 @@
+from scripts.pipeline import scheduler
+
+
+def test_learn_model(tmp_path):
+    path = scheduler.model_path(str(tmp_path))
+    model = scheduler.read_model(path)
+    assert scheduler.estimate_mb(model, 100, ["filter_data"]) == \
+        scheduler.DEFAULT_BASE_MB + 100 * scheduler.DEFAULT_EXPANSION
+
+    summary = [{"file": "a", "status": "success", "base_rss": 200,
+                "metrics": {"filter_data": {"peak_rss": 500},
+                            "ica_raw": {"peak_rss": 1000}}},
+               {"file": "b", "status": "failed", "base_rss": 200,
+                "metrics": None}]
+    scheduler.record(path, summary, {"a": 100, "b": 100})
+
+    # the largest expansion of the steps run counts
+    model = scheduler.read_model(path)
+    assert scheduler.expansion(model, "filter_data") == 3
+    assert scheduler.estimate_mb(model, 50, ["filter_data", "ica_raw"]) == \
+        200 + 50 * 8
+
+
+def test_next_file():
+    estimates = [300, 500, 200, 900]
+    pending = [1, 0, 2]
+
+    # the largest pending file that fits
+    assert scheduler.next_file(estimates, pending, [3], 1500) == 1
+    assert scheduler.next_file(estimates, pending, [3], 1200) == 0
+    assert scheduler.next_file(estimates, pending, [3], 1000) is None
+
+    # a file larger than the budget runs alone
+    assert scheduler.next_file(estimates, [3], [], 800) == 3
+    assert scheduler.next_file(estimates, [3], [2], 800) is None
@@ -5,7 +5,9 @@ import pytest
 
 from pathlib import Path
 
+import mne
 import mne_bids
+import numpy as np
 from mne import Epochs
 
 
@@ -74,3 +76,34 @@ def test_except_value(default_param, error_obj):
         assert True
 
         assert isinstance(output_dict, dict)
+
+
+def test_memmap_preload(default_param, tmp_path):
+    # synthetic recording with events stored as annotations
+    info = mne.create_info(["Fp1", "Fp2", "FC1"], 250., "eeg")
+    data = np.random.RandomState(0).randn(3, 250 * 60) * 1e-5
+    raw = mne.io.RawArray(data, info, verbose=False)
+    raw.set_annotations(mne.Annotations(np.arange(2, 58, 0.5), 0, "stim"))
+
+    seg_param = dict(default_param["preprocess"]["segment_data"])
+    seg_param["preload"] = True
+    epochs, output_dict = pre.segment_data(raw, **seg_param)
+
+    seg_param["preload"] = str(tmp_path)
+    mm_epochs, mm_output = pre.segment_data(raw, **seg_param)
+
+    # same epochs, stored in an unlinked file of the given directory
+    assert isinstance(mm_epochs._data, np.memmap)
+    assert pre._memmap_dir(mm_epochs) == str(tmp_path)
+    assert not list(tmp_path.iterdir())
+    np.testing.assert_array_equal(mm_epochs.get_data(), epochs.get_data())
+
+    # counts are taken from the epochs, not the channel data
+    assert mm_output == output_dict
+    assert set(output_dict["Segment"]["Generated Epochs"].values()) == {len(epochs)}
+
+    # copies are held in memory, the epochs they were made from are not
+    copy = mm_epochs.copy()
+    assert getattr(copy._data, "_mmap", None) is None
+    assert pre._memmap_dir(mm_epochs) == str(tmp_path)
+    np.testing.assert_array_equal(copy.get_data(), epochs.get_data())
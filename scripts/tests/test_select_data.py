@@ -60,6 +60,20 @@ def test_select_all(default_param, avail_subj, subj_files):
     assert len(data) == count
 
 
+def test_select_index(default_param, tmp_path):
+    # Load data by searching the dataset directly
+    data = load.load_files(default_param["load_data"])
+
+    # Load data through a freshly built on-disk index, then reuse it
+    default_param["load_data"]["index"] = str(tmp_path / "bids_index.json")
+    data_index = load.load_files(default_param["load_data"])
+    data_cached = load.load_files(default_param["load_data"])
+
+    # check that the index selects exactly the same files
+    assert sorted(map(str, data_index)) == sorted(map(str, data))
+    assert sorted(map(str, data_cached)) == sorted(map(str, data))
+
+
 def test_select_subj(default_param, subj_files):
     # select participants (make this a random selection?)
     selected_subjects = ["NDARAB793GL3"]
@@ -478,3 +492,35 @@ def test_missing_data(default_param, tmp_path):
     with pytest.raises(Exception):
         load.load_files(default_param["load_data"])
         assert True
+
+
+def test_except_wildcards():
+    files = [mne_bids.BIDSPath(subject=sub, task=task, run=run,
+                               datatype="eeg", check=False)
+             for sub in ["A01", "A02", "B01"]
+             for task in ["rest", "flanker"]
+             for run in ["01", "02"]]
+
+    # exclude run 02 of every task of the A subjects
+    data = load._filter_exceptions(["A*"], ["*"], ["02"], files)
+    assert len(data) == 8
+    assert all(f.run == "01" or f.subject == "B01" for f in data)
+
+    # exact values and wildcards can be mixed
+    data = load._filter_exceptions(["B01", "A0[2]"], ["rest"], ["*"], files)
+    assert len(data) == 8
+
+    # an empty exception list omits nothing
+    assert load._filter_exceptions("", "", "", files) == files
+
+    # numbers in user_params are matched as strings
+    files = [f.copy().update(run=int(f.run)) for f in files]
+    data = load._filter_exceptions(["A*"], ["*"], [2], files)
+    assert len(data) == 8
+
+    # null matches the recordings without the entity
+    files.append(mne_bids.BIDSPath(subject="A01", task="rest",
+                                   datatype="eeg", check=False))
+    data = load._filter_exceptions(["A01"], ["rest"], [None], files)
+    assert len(data) == 12
+    assert all(f.run is not None for f in data)
@@ -0,0 +1,31 @@
+from scripts.pipeline import shard
+
+import pytest
+
+
+def test_balance():
+    costs = [7, 5, 4, 3, 3, 2]
+    groups = shard.balance(costs, 2)
+
+    loads = [sum(c for c, g in zip(costs, groups) if g == i) for i in range(2)]
+    assert sorted(loads) == [12, 12]
+    # the same costs always give the same split
+    assert shard.balance(costs, 2) == groups
+
+
+def test_shard_files():
+    files = ["a", "b", "c", "d", "e"]
+    costs = {"a": 1, "b": 10, "c": 3, "d": 8, "e": 2}
+    shards = [shard.shard_files(files, i, 3, cost=costs.get)
+              for i in range(3)]
+
+    # every file lands in exactly one shard, in its original order
+    assert sorted(f for s in shards for f in s) == files
+    assert all(s == sorted(s) for s in shards)
+    assert ["b"] in shards
+
+
+@pytest.mark.parametrize("value", ["1", "2/2", "-1/2", "a/b", "0/0"])
+def test_parse_shard_invalid(value):
+    with pytest.raises(ValueError):
+        shard.parse_shard(value)
@@ -0,0 +1,73 @@
+from scripts.data import store
+
+import pytest
+
+import mne
+import numpy as np
+import os
+
+
+@pytest.fixture
+def raw():
+    info = mne.create_info(["Cz", "Pz", "Oz"], 100., "eeg")
+    raw = mne.io.RawArray(np.random.RandomState(0).randn(3, 1000) * 1e-5,
+                          info, first_samp=50, verbose=False)
+    raw.set_annotations(mne.Annotations([1., 4.], [0.5, 1.],
+                                        ["BAD_blink", "stim"]))
+    raw.info["bads"] = ["Oz"]
+    return raw
+
+
+def test_stages(tmp_path, raw):
+    path = str(tmp_path / "sub-1_proc-intermediates_eeg.h5")
+    epochs = mne.make_fixed_length_epochs(raw, duration=1., preload=True,
+                                          verbose=False)
+    store.write_stage(raw, "filter_data", path, fmt="double")
+    store.write_stage(epochs, "segment_data", path)
+    assert store.stages(path) == ["filter_data", "segment_data"]
+
+    # continuous data, its annotations and bad channels come back as saved
+    stage = store.read_stage(path, "filter_data")
+    np.testing.assert_array_equal(stage.get_data(), raw.get_data())
+    assert stage.first_samp == raw.first_samp
+    assert list(stage.annotations.description) == ["BAD_blink", "stim"]
+    np.testing.assert_allclose(stage.annotations.onset,
+                               raw.annotations.onset)
+    np.testing.assert_allclose(stage.annotations.duration,
+                               raw.annotations.duration)
+    assert stage.info["bads"] == ["Oz"]
+
+    # also relative to the measurement date, if the recording has one
+    dated = raw.copy().set_meas_date(0)
+    store.write_stage(dated, "reref_raw", path)
+    stage = store.read_stage(path, "reref_raw")
+    np.testing.assert_allclose(stage.annotations.onset,
+                               dated.annotations.onset)
+    assert stage.annotations.orig_time == dated.annotations.orig_time
+
+    # epochs in single precision, with their events and drop log
+    stage = store.read_stage(path, "segment_data")
+    np.testing.assert_allclose(stage.get_data(), epochs.get_data(),
+                               rtol=1e-6)
+    np.testing.assert_array_equal(stage.events, epochs.events)
+    assert stage.drop_log == epochs.drop_log
+
+    # a subset of channels and samples is read on its own
+    data = store.read_data(path, "filter_data", picks=["Oz", "Cz"],
+                           start=10, stop=20)
+    np.testing.assert_array_equal(data, raw.get_data([0, 2], 10, 20))
+
+    # a stage written again replaces the earlier one
+    store.write_stage(raw.copy().crop(0, 5), "filter_data", path)
+    assert store.read_stage(path, "filter_data").n_times == 501
+    assert store.stages(path) == ["filter_data", "reref_raw", "segment_data"]
+    np.testing.assert_array_equal(
+        store.read_stage(path, "segment_data").get_data(),
+        stage.get_data())
+
+    # and gives its space back
+    size = os.path.getsize(path)
+    for _ in range(3):
+        store.write_stage(raw.copy().crop(0, 5), "filter_data", path)
+    assert os.path.getsize(path) == size
+    assert os.listdir(tmp_path) == [os.path.basename(path)]
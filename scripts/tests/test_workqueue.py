@@ -0,0 +1,115 @@
+from scripts.pipeline import runner, workqueue
+
+import pytest
+
+import collections
+import json
+import os
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+
+@pytest.fixture
+def tasks(tmp_path):
+    # two tasks sharing a queue, as if on different nodes
+    path = workqueue.queue_dir(str(tmp_path), "run")
+    tasks = [workqueue.WorkQueue(path, ttl=60., max_attempts=2)
+             for _ in range(2)]
+    tasks[1].owner = "other:1"
+    yield tasks
+    for task in tasks:
+        task.close()
+
+
+def _expire(task, file):
+    # pretend the task holding the claim stopped renewing it
+    path = task._claim_path(file)
+    os.utime(path, (0, 0))
+
+
+def test_claim_once(tasks):
+    file = SimpleNamespace(basename="sub-1_eeg.vhdr")
+    first, second = tasks
+
+    assert first.claim(file)
+    assert not second.claim(file)
+
+    first.complete(file, "success")
+    assert second.is_done(file)
+    assert not second.claim(file)
+    assert os.listdir(os.path.join(first.path, "claims")) == []
+
+
+def test_expired_claim(tasks):
+    file = SimpleNamespace(basename="sub-2_eeg.vhdr")
+    first, second = tasks
+
+    # the claim of a task that died is taken over
+    assert first.claim(file)
+    _expire(first, file)
+    assert second.claim(file)
+
+    # the first task stops renewing the claim it lost
+    path = second._claim_path(file)
+    os.utime(path, (0, 0))
+    first._renew_claims()
+    assert os.path.getmtime(path) == 0
+    assert path not in first._held
+
+    # and may not release it
+    first.release(file)
+    assert os.path.exists(path)
+
+    # a file whose claims keep expiring is given up
+    _expire(second, file)
+    assert not first.claim(file)
+    with open(first._done_path(file)) as fp:
+        assert json.load(fp)["status"] == "failed"
+
+
+def test_take_over_race(tasks, monkeypatch):
+    file = SimpleNamespace(basename="sub-3_eeg.vhdr")
+    first, second = tasks
+
+    # the claim looked expired, but was renewed before it was moved away
+    assert first.claim(file)
+    monkeypatch.setattr(workqueue.os.path, "getmtime", lambda path: 0)
+    assert not second.claim(file)
+    with open(first._claim_path(file)) as fp:
+        assert json.load(fp)["owner"] == first.owner
+    assert os.listdir(os.path.join(first.path, "claims")) == \
+        [file.basename + ".claim"]
+
+
+def test_admit_claimed(tasks):
+    files = [SimpleNamespace(basename="sub-{}_eeg.vhdr".format(idx))
+             for idx in range(10)]
+    first, second = tasks
+    first.poll = 0.2
+    for file in files[:5]:
+        assert second.claim(file)
+
+    calls = collections.Counter()
+    claim = first.claim
+
+    def counted_claim(file):
+        calls[file.basename] += 1
+        return claim(file)
+
+    def submit(file):
+        # the other task finishes its files with the last free one
+        if file is files[-1]:
+            for other in files[:5]:
+                second.complete(other, "success")
+        future = Future()
+        future.set_result({"file": file.basename, "status": "success",
+                           "elapsed": 0.})
+        return future
+
+    # files claimed by the other task are tried once per poll, not after
+    # every file this task finishes
+    first.claim = counted_claim
+    summary = runner._admit_files(submit, files, 1, None, None, first)
+    assert [result["file"] for result in summary] == \
+        [file.basename for file in files[5:]]
+    assert all(calls[file.basename] <= 2 for file in files[:5])